@@ -0,0 +1,493 @@
+"""Seed the test database and replay a mix of requests against every route.
+
+    $ pipenv run python -m benchmarks.load [--users 200] [--posts 1000]
+          [--requests 2000] [--output FILE] [--compare FILE]
+
+Reports p50 / p95 / p99 latency, throughput and SQL queries per request
+for each route, and writes them as JSON (by default to
+benchmarks/results/<commit>.json) so that runs can be compared.
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import random
+import subprocess
+import time
+from hashlib import sha256
+import psycopg2.extras
+from faker import Faker
+from flask import g
+from PIL import Image
+import main
+
+PASSWORD = 'password'
+UPLOAD_FILE = os.path.join(os.path.dirname(__file__), os.pardir, 'test',
+                           'data', 'kids_chuunibyou_girl.png')
+
+
+def zipf_weights(count, exponent):
+    return [1 / (rank + 1) ** exponent for rank in range(count)]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+
+def upload_form(title, description):
+    with open(UPLOAD_FILE, 'rb') as f:
+        data = f.read()
+    return {
+        'file': (io.BytesIO(data), 'upload.png'),
+        'title': title, 'description': description,
+    }
+
+
+def seed_images(count, rng):
+    folder = main.app.config['UPLOAD_FOLDER']
+    filenames = []
+    for _ in range(count):
+        color = tuple(rng.randrange(256) for _ in range(3))
+        buf = io.BytesIO()
+        Image.new('RGB', (640, 480), color).save(buf, 'PNG')
+        data = buf.getvalue()
+        filename = f'{sha256(data).hexdigest()}.png'
+        with open(os.path.join(folder, filename), 'wb') as f:
+            f.write(data)
+        main.make_derivatives(folder, filename,
+                              main.app.config['DERIVATIVE_SIZES'])
+        filenames.append(filename)
+    return filenames
+
+
+def seed(args, rng, fake):
+    main.initialize()
+    images = seed_images(args.images, rng)
+    user_ids = range(1, args.users + 1)
+    # Popularity follows a power law: a few users get most of the follows,
+    # posts and favorites
+    user_weights = zipf_weights(args.users, args.skew)
+
+    conn = main.connect_db()
+    with conn:
+        cursor = conn.cursor()
+        salt = 'benchmarkbenchmarkbenchmarkbench'
+        psycopg2.extras.execute_values(cursor, '''
+        INSERT INTO users (username, salt, password, description) VALUES %s
+        ''', [
+            (f'{fake.first_name().lower()}_{i}', salt,
+             main.passhash(PASSWORD, salt), fake.sentence())
+            for i in user_ids
+        ])
+        cursor.execute('INSERT INTO event_haveread (user_id) '
+                       'SELECT id FROM users')
+
+        relations = {
+            (follower_id, following_id)
+            for follower_id in user_ids
+            for following_id in rng.choices(user_ids, user_weights,
+                                            k=args.follows)
+            if follower_id != following_id
+        }
+        psycopg2.extras.execute_values(cursor, '''
+        INSERT INTO relations (follower_id, following_id) VALUES %s
+        ''', sorted(relations))
+
+        posts = [
+            (author_id, fake.sentence(nb_words=4).rstrip('.'),
+             fake.paragraph(), rng.choice(images))
+            for author_id in rng.choices(user_ids, user_weights,
+                                         k=args.posts)
+        ]
+        psycopg2.extras.execute_values(cursor, '''
+        INSERT INTO posts (user_id, title, description, path) VALUES %s
+        ''', posts)
+        post_ids = range(1, args.posts + 1)
+        post_weights = zipf_weights(args.posts, args.skew)
+        rng.shuffle(post_weights)
+
+        favorites = {
+            (user_id, post_id)
+            for user_id in user_ids
+            for post_id in rng.choices(post_ids, post_weights,
+                                       k=args.favorites)
+        }
+        psycopg2.extras.execute_values(cursor, '''
+        INSERT INTO favorites (user_id, post_id) VALUES %s
+        ''', sorted(favorites))
+        comments = [
+            (rng.choices(post_ids, post_weights)[0], rng.choice(user_ids),
+             fake.sentence())
+            for _ in range(args.comments)
+        ]
+        psycopg2.extras.execute_values(cursor, '''
+        INSERT INTO comments (post_id, user_id, content) VALUES %s
+        ''', comments)
+
+        # Events are produced the way requests produce them: through the
+        # outbox, so that coalescing and timelines are filled as in
+        # production
+        psycopg2.extras.execute_values(cursor, '''
+        INSERT INTO event_outbox (type, invoker_id, source_id, receiver_id)
+        VALUES %s
+        ''', [('follow', follower_id, None, following_id)
+              for follower_id, following_id in sorted(relations)] +
+            [('post', post[0], post_id, None)
+             for post_id, post in zip(post_ids, posts)] +
+            [('favorite', user_id, post_id, None)
+             for user_id, post_id in sorted(favorites)] +
+            [('comment', comment[1], comment[0], None)
+             for comment in comments])
+    while main.drain_outbox(conn, 1000):
+        pass
+    conn.close()
+    main.ranking.refresh()
+    return images
+
+
+def load_state(usernames):
+    conn = main.connect_db()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT u.username,
+        ARRAY(SELECT post_id FROM favorites WHERE user_id = u.id)
+        AS favorites,
+        ARRAY(SELECT id FROM posts WHERE user_id = u.id) AS posts,
+        ARRAY(
+            SELECT f.username FROM relations r
+            INNER JOIN users f ON f.id = r.following_id
+            WHERE r.follower_id = u.id
+        ) AS following
+        FROM users u
+        WHERE username = ANY(%s)
+        ''', (usernames,))
+        state = {
+            row['username']: {
+                'favorites': set(row['favorites']),
+                'posts': set(row['posts']),
+                'following': set(row['following']),
+            }
+            for row in cursor
+        }
+    conn.close()
+    return state
+
+
+class Session:
+    def __init__(self, username=None):
+        self.client = main.app.test_client()
+        self.username = username
+        if username:
+            self.client.post('/login', data={
+                'username': username, 'password': PASSWORD,
+            })
+
+
+def request_mix(ctx):
+    rng = ctx['rng']
+
+    def post_id():
+        while True:
+            target = rng.randrange(1, ctx['posts'] + 1)
+            if target not in ctx['deleted']:
+                return target
+
+    def username():
+        return rng.choice(ctx['usernames'])
+
+    def favorite(state):
+        candidates = set(range(1, ctx['posts'] + 1)) - state['favorites'] \
+            - ctx['deleted']
+        target = rng.choice(sorted(candidates))
+        state['favorites'].add(target)
+        return 'POST', f'/favorite/{target}', None
+
+    def unfavorite(state):
+        target = rng.choice(sorted(state['favorites']))
+        state['favorites'].discard(target)
+        return 'POST', f'/unfavorite/{target}', None
+
+    def follow(state, session):
+        candidates = set(ctx['usernames']) - state['following']
+        target = rng.choice(sorted(candidates - {session.username}))
+        state['following'].add(target)
+        return 'POST', '/follow', {'username': target}
+
+    def unfollow(state):
+        target = rng.choice(sorted(state['following']))
+        state['following'].discard(target)
+        return 'POST', '/unfollow', {'username': target}
+
+    def upload():
+        fake = ctx['fake']
+        return 'POST', '/upload', upload_form(
+            fake.sentence(nb_words=4).rstrip('.'), fake.paragraph()
+        )
+
+    def delete_post(state):
+        target = rng.choice(sorted(state['posts']))
+        state['posts'].discard(target)
+        ctx['deleted'].add(target)
+        return 'POST', f'/post/{target}/delete', None
+
+    def register():
+        return 'POST', '/register', {
+            'username': f'bench_{next(ctx["registered"])}',
+            'password': PASSWORD, 'description': ctx['fake'].sentence(),
+        }
+
+    # (label, weight, logged in, request factory). Requests that are not
+    # logged in use a shared client, except for those made with a new one
+    # (None) because they log it in or out.
+    return [
+        ('index', 15, False, lambda s, st: ('GET', '/', None)),
+        ('index (logged in)', 10, True, lambda s, st: ('GET', '/', None)),
+        ('list_posts', 10, False, lambda s, st: ('GET', '/posts', None)),
+        ('posts_ranking', 8, False,
+         lambda s, st: ('GET', '/posts/ranking', None)),
+        ('search_posts', 5, False, lambda s, st: (
+            'GET', f'/posts/search?query={rng.choice(ctx["words"])}', None
+        )),
+        ('userpage', 10, False,
+         lambda s, st: ('GET', f'/@{username()}', None)),
+        ('show_post', 15, False,
+         lambda s, st: ('GET', f'/post/{post_id()}', None)),
+        ('list_favorite', 3, False,
+         lambda s, st: ('GET', f'/@{username()}/favorites', None)),
+        ('users_following', 2, False,
+         lambda s, st: ('GET', f'/@{username()}/following', None)),
+        ('users_follower', 2, False,
+         lambda s, st: ('GET', f'/@{username()}/follower', None)),
+        ('mypage', 1, True, lambda s, st: ('GET', '/mypage', None)),
+        ('list_my_favorite', 1, True,
+         lambda s, st: ('GET', '/favorites', None)),
+        ('following', 1, True, lambda s, st: ('GET', '/following', None)),
+        ('follower', 1, True, lambda s, st: ('GET', '/follower', None)),
+        ('list_events', 5, True, lambda s, st: ('GET', '/events', None)),
+        ('stream_events', 1, True,
+         lambda s, st: ('GET', '/events/stream', None)),
+        ('show_metrics', 1, False, lambda s, st: ('GET', '/metrics', None)),
+        ('login (form)', 1, False, lambda s, st: ('GET', '/login', None)),
+        ('login', 1, None, lambda s, st: ('POST', '/login', {
+            'username': username(), 'password': PASSWORD,
+        })),
+        ('logout', 1, None, lambda s, st: ('GET', '/logout', None)),
+        ('register_user (form)', 1, False,
+         lambda s, st: ('GET', '/register', None)),
+        ('register_user', 1, None, lambda s, st: register()),
+        ('setting (form)', 1, True, lambda s, st: ('GET', '/setting', None)),
+        ('setting', 1, True, lambda s, st: (
+            'POST', '/setting', {'description': ctx['fake'].sentence()}
+        )),
+        ('upload (form)', 1, True, lambda s, st: ('GET', '/upload', None)),
+        ('upload', 1, True, lambda s, st: upload()),
+        ('delete_post', 1, True, lambda s, st: (
+            delete_post(st) if st['posts'] else upload()
+        )),
+        ('image_from_uploads', 10, False, lambda s, st: (
+            'GET', '/uploads/' + main.derivative_name(
+                rng.choice(ctx['images']), 'thumb'
+            ), None
+        )),
+        ('create_favorite', 3, True, lambda s, st: favorite(st)),
+        ('delete_favorite', 2, True, lambda s, st: (
+            unfavorite(st) if st['favorites'] else favorite(st)
+        )),
+        ('post_comment', 2, True, lambda s, st: (
+            'POST', f'/post/{post_id()}/comment',
+            {'content': ctx['fake'].sentence()}
+        )),
+        ('follow', 1, True, lambda s, st: follow(st, s)),
+        ('unfollow', 1, True, lambda s, st: (
+            unfollow(st) if st['following'] else follow(st, s)
+        )),
+    ]
+
+
+def replay(args, ctx, sessions, state):
+    rng = ctx['rng']
+    mix = request_mix(ctx)
+    anonymous = Session()
+    queries = []
+
+    def count_queries(response):
+        queries.append(g.get('query_count', 0))
+        return response
+
+    results = {}
+    after_request = main.app.after_request_funcs.setdefault(None, [])
+    after_request.append(count_queries)
+    try:
+        started = time.perf_counter()
+        for i in range(args.warmup + args.requests):
+            label, _, logged_in, make = rng.choices(
+                mix, [item[1] for item in mix]
+            )[0]
+            if logged_in is None:
+                session = Session()
+            else:
+                session = rng.choice(sessions) if logged_in else anonymous
+            method, path, data = make(session, state.get(session.username))
+            queries.clear()
+            request_started = time.perf_counter()
+            res = session.client.open(path, method=method, data=data)
+            if res.mimetype == 'text/event-stream':
+                # Streams never end; this times the first message
+                next(iter(res.response))
+            else:
+                res.get_data()
+            res.close()
+            elapsed = time.perf_counter() - request_started
+            if i == args.warmup:
+                started = request_started
+            if i >= args.warmup:
+                result = results.setdefault(label, {
+                    'latency': [], 'queries': [], 'errors': 0,
+                })
+                result['latency'].append(elapsed)
+                result['queries'].append(sum(queries))
+                result['errors'] += res.status_code >= 500
+            if i % 100 == 99:
+                # Stand in for the outbox worker, outside of the timing
+                pause = time.perf_counter()
+                conn = main.connect_db()
+                main.drain_outbox(conn, 1000)
+                conn.close()
+                started += time.perf_counter() - pause
+        duration = time.perf_counter() - started
+    finally:
+        after_request.remove(count_queries)
+    return results, duration
+
+
+def summarize(latency, queries, errors=0):
+    return {
+        'count': len(latency),
+        'errors': errors,
+        'p50_ms': percentile(latency, 50) * 1000,
+        'p95_ms': percentile(latency, 95) * 1000,
+        'p99_ms': percentile(latency, 99) * 1000,
+        'mean_ms': sum(latency) / len(latency) * 1000,
+        'queries_per_request': sum(queries) / len(queries),
+    }
+
+
+def report(summary, baseline=None):
+    print(f'{"route":<20} {"count":>6} {"p50 ms":>8} {"p95 ms":>8} '
+          f'{"p99 ms":>8} {"queries":>8}')
+    rows = sorted(summary['routes'].items()) + [('total', summary['total'])]
+    for label, stats in rows:
+        line = (f'{label:<20} {stats["count"]:>6} {stats["p50_ms"]:>8.2f} '
+                f'{stats["p95_ms"]:>8.2f} {stats["p99_ms"]:>8.2f} '
+                f'{stats["queries_per_request"]:>8.2f}')
+        if baseline:
+            old = baseline['routes'].get(label) or (
+                baseline['total'] if label == 'total' else None
+            )
+            if old:
+                change = (stats['p95_ms'] / old['p95_ms'] - 1) * 100
+                line += f'  p95 {change:+.1f}%'
+        print(line)
+    print(f'throughput: {summary["throughput_rps"]:.1f} requests/s')
+
+
+def commit_id():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], check=True,
+            stdout=subprocess.PIPE, universal_newlines=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--follows', type=int, default=20,
+                        help='follows drawn per user')
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--images', type=int, default=50)
+    parser.add_argument('--favorites', type=int, default=20,
+                        help='favorites drawn per user')
+    parser.add_argument('--comments', type=int, default=2000)
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='power-law exponent of popularity')
+    parser.add_argument('--sessions', type=int, default=20,
+                        help='logged-in users replaying requests')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output')
+    parser.add_argument('--compare', help='earlier result file')
+    args = parser.parse_args()
+
+    main.app.testing = True
+    main.app.config['UPLOAD_FOLDER'] = os.environ['TEST_UPLOAD_FOLDER']
+    main.app.config['EVENT_STREAMS'] = True
+    rng = random.Random(args.seed)
+    fake = Faker()
+    fake.seed_instance(args.seed)
+
+    started = time.perf_counter()
+    images = seed(args, rng, fake)
+    print(f'seeded in {time.perf_counter() - started:.1f} s')
+
+    conn = main.connect_db()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT username FROM users ORDER BY id')
+        usernames = [row['username'] for row in cursor]
+        cursor.execute('SELECT title FROM posts ORDER BY id')
+        words = sorted({
+            word.lower() for row in cursor for word in row['title'].split()
+        })
+    conn.close()
+    main.notifications.ensure_started()
+    main.notifications.connected.wait(5)
+
+    session_users = rng.sample(usernames, min(args.sessions, len(usernames)))
+    sessions = [Session(username) for username in session_users]
+    ctx = {
+        'rng': rng, 'fake': fake, 'posts': args.posts, 'images': images,
+        'usernames': usernames, 'words': words,
+        'deleted': set(), 'registered': itertools.count(),
+    }
+    results, duration = replay(args, ctx, sessions,
+                               load_state(session_users))
+
+    latency = [v for result in results.values() for v in result['latency']]
+    queries = [v for result in results.values() for v in result['queries']]
+    summary = {
+        'commit': commit_id(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'parameters': vars(args),
+        'throughput_rps': len(latency) / duration,
+        'total': summarize(latency, queries,
+                           sum(r['errors'] for r in results.values())),
+        'routes': {
+            label: summarize(r['latency'], r['queries'], r['errors'])
+            for label, r in results.items()
+        },
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(summary, baseline)
+
+    output = args.output or os.path.join(
+        os.path.dirname(__file__), 'results', f'{summary["commit"]}.json'
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+    print(f'wrote {output}')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,64 @@
+"""CPU time spent per /uploads request with and without gzip of images.
+
+    $ pipenv run python -m benchmarks.uploads_compression [-n 500] [FILE]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import main
+
+IMAGE_MIMETYPES = sorted(main.PERMITTED_MIMETYPES)
+
+
+def cpu_time_per_request(client, url, count, headers):
+    client.get(url, headers=headers)
+    started = time.process_time()
+    for _ in range(count):
+        client.get(url, headers=headers)
+    return (time.process_time() - started) / count
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('file', nargs='?',
+                        default='test/data/kids_chuunibyou_girl.png')
+    parser.add_argument('-n', '--requests', type=int, default=500)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        filename = os.path.basename(args.file)
+        shutil.copy(args.file, os.path.join(folder, filename))
+        main.app.config['UPLOAD_FOLDER'] = folder
+        client = main.app.test_client()
+        url = f'/uploads/{filename}'
+        gzip = {'Accept-Encoding': 'gzip'}
+        default_mimetypes = main.app.config['COMPRESS_MIMETYPES']
+
+        main.app.config['COMPRESS_MIMETYPES'] = \
+            default_mimetypes + IMAGE_MIMETYPES
+        gzipped = cpu_time_per_request(client, url, args.requests, gzip)
+        main.app.config['COMPRESS_MIMETYPES'] = default_mimetypes
+        plain = cpu_time_per_request(client, url, args.requests, gzip)
+        etag = client.get(url).get_etag()[0]
+        revalidated = cpu_time_per_request(
+            client, url, args.requests, dict(gzip, **{
+                'If-None-Match': f'"{etag}"',
+            })
+        )
+    finally:
+        shutil.rmtree(folder)
+
+    size = os.path.getsize(args.file)
+    print(f'{args.file} ({size} bytes), {args.requests} requests each')
+    print(f'gzip images    {gzipped * 1e6:10.1f} us CPU / request')
+    print(f'no gzip        {plain * 1e6:10.1f} us CPU / request')
+    print(f'304 revalidate {revalidated * 1e6:10.1f} us CPU / request')
+    print(f'saved by not compressing images: '
+          f'{(gzipped - plain) * 1e6:.1f} us CPU / request')
+
+
+if __name__ == '__main__':
+    run()
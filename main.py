@@ -1,32 +1,424 @@
 import os
 import random
 import glob
+import gzip
+import pickle
+import queue
+import re
+import select
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import zlib
+from datetime import date, timedelta
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from functools import wraps
+import click
 from hashlib import sha256
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 import psycopg2.errorcodes
 from dotenv import load_dotenv, find_dotenv
 from flask import (
     Flask,
+    Markup,
+    Request,
     abort,
     flash,
     g,
+    has_app_context,
+    has_request_context,
     redirect,
-    render_template,
     request,
+    safe_join,
     send_from_directory,
     session,
+    stream_with_context,
     url_for,
 )
+from flask import render_template as flask_render_template
 from flask_compress import Compress
+from PIL import Image
 load_dotenv(find_dotenv())
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
 app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER')
+app.config['MAX_UPLOAD_SIZE'] = int(
+    os.environ.get('MAX_UPLOAD_SIZE', 16 * 1024 * 1024)
+)
+app.config['DERIVATIVE_SIZES'] = {
+    'thumb': (int(os.environ.get('THUMBNAIL_SIZE', 256)),) * 2,
+    'medium': (int(os.environ.get('MEDIUM_SIZE', 1024)),) * 2,
+}
+app.config['IMAGE_WORKERS'] = int(os.environ.get('IMAGE_WORKERS', 2))
+app.config['PAGE_SIZE'] = int(os.environ.get('PAGE_SIZE', 20))
+app.config['STREAM_LISTINGS'] = bool(
+    int(os.environ.get('STREAM_LISTINGS', 0))
+)
+app.config['STREAM_BATCH_SIZE'] = int(
+    os.environ.get('STREAM_BATCH_SIZE', 100)
+)
+app.config['RANKING_SIZE'] = int(os.environ.get('RANKING_SIZE', 100))
+app.config['RANKING_REFRESH_INTERVAL'] = float(
+    os.environ.get('RANKING_REFRESH_INTERVAL', 300)
+)
+app.config['RANKING_REFRESH_CHANGES'] = int(
+    os.environ.get('RANKING_REFRESH_CHANGES', 100)
+)
+app.config['OUTBOX_BATCH_SIZE'] = int(os.environ.get('OUTBOX_BATCH_SIZE', 100))
+app.config['OUTBOX_MAX_ATTEMPTS'] = int(
+    os.environ.get('OUTBOX_MAX_ATTEMPTS', 5)
+)
+app.config['OUTBOX_POLL_INTERVAL'] = float(
+    os.environ.get('OUTBOX_POLL_INTERVAL', 5)
+)
+app.config['TIMELINE_SIZE'] = int(os.environ.get('TIMELINE_SIZE', 200))
+app.config['TIMELINE_FANOUT_LIMIT'] = int(
+    os.environ.get('TIMELINE_FANOUT_LIMIT', 1000)
+)
+app.config['UNREAD_CACHE_SIZE'] = int(
+    os.environ.get('UNREAD_CACHE_SIZE', 10000)
+)
+app.config['UNREAD_CACHE_TTL'] = float(
+    os.environ.get('UNREAD_CACHE_TTL', 60)
+)
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 300))
+app.config['PAGE_CACHE_SIZE'] = int(os.environ.get('PAGE_CACHE_SIZE', 1000))
+app.config['PAGE_CACHE_FOLDER'] = os.environ.get('PAGE_CACHE_FOLDER')
+app.config['POST_CARD_CACHE_SIZE'] = int(
+    os.environ.get('POST_CARD_CACHE_SIZE', 10000)
+)
+app.config['SEARCH_CACHE_SIZE'] = int(
+    os.environ.get('SEARCH_CACHE_SIZE', 1000)
+)
+app.config['SEARCH_CACHE_TTL'] = float(
+    os.environ.get('SEARCH_CACHE_TTL', 300)
+)
+app.config['EVENTS_COALESCE_WINDOW'] = float(
+    os.environ.get('EVENTS_COALESCE_WINDOW', 24 * 60 * 60)
+)
+app.config['EVENTS_RETENTION_DAYS'] = int(
+    os.environ.get('EVENTS_RETENTION_DAYS', 365)
+)
+app.config['EVENTS_PARTITIONS_AHEAD'] = int(
+    os.environ.get('EVENTS_PARTITIONS_AHEAD', 3)
+)
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 100))
+app.config['METRICS_FOLDER'] = os.environ.get('METRICS_FOLDER')
+app.config['METRICS_WRITE_INTERVAL'] = float(
+    os.environ.get('METRICS_WRITE_INTERVAL', 5)
+)
+app.config['EVENT_STREAM_KEEPALIVE'] = float(
+    os.environ.get('EVENT_STREAM_KEEPALIVE', 15)
+)
+app.config['EVENT_STREAM_BACKLOG'] = int(
+    os.environ.get('EVENT_STREAM_BACKLOG', 100)
+)
+# Each stream stays open for as long as the page, so streams are only
+# offered when serve() runs gevent workers
+app.config['EVENT_STREAMS'] = False
+app.config['POOL_MIN_SIZE'] = int(
+    os.environ.get('POSTGRESQL_POOL_MIN_SIZE', 1)
+)
+app.config['POOL_MAX_SIZE'] = int(
+    os.environ.get('POSTGRESQL_POOL_MAX_SIZE', 10)
+)
+app.config['POOL_TIMEOUT'] = float(
+    os.environ.get('POSTGRESQL_POOL_TIMEOUT', 5)
+)
+app.config['POOL_CHECK_INTERVAL'] = float(
+    os.environ.get('POSTGRESQL_POOL_CHECK_INTERVAL', 30)
+)
 PERMITTED_MIMETYPES = {'image/jpeg', 'image/png', 'image/gif'}
+# Uploaded images are already compressed, so they are left out of
+# COMPRESS_MIMETYPES on purpose
 Compress(app)
-app.config['COMPRESS_MIMETYPES'] += list(PERMITTED_MIMETYPES)
+UPLOAD_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class Metrics:
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+               2.5, 5, 10)
+
+    def __init__(self):
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, help_text):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets=BUCKETS):
+        key = (name, tuple(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': buckets, 'counts': [0] * len(buckets),
+                    'sum': 0, 'count': 0,
+                }
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            '{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                             .replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    def snapshot(self, gauges=()):
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'histograms': {
+                    key: dict(value, counts=list(value['counts']))
+                    for key, value in self._histograms.items()
+                },
+                'gauges': {
+                    (name, tuple(labels)): value
+                    for name, labels, value in gauges
+                },
+            }
+
+    # Worker processes each write their snapshot to a file of the metrics
+    # folder; a scrape, answered by any one of them, adds all files up.
+    def write(self, folder, gauges=()):
+        path = os.path.join(folder, f'{os.getpid()}.pickle')
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(self.snapshot(gauges), f)
+        os.replace(path + '.tmp', path)
+
+    def read(self, folder):
+        snapshots = []
+        for path in glob.glob(os.path.join(folder, '*.pickle')):
+            try:
+                with open(path, 'rb') as f:
+                    snapshot = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                continue
+            pid = int(os.path.basename(path).split('.')[0])
+            if not process_alive(pid):
+                # What an exited worker counted still adds up; its gauges
+                # no longer do
+                snapshot['gauges'] = {
+                    key: value for key, value in snapshot['gauges'].items()
+                    if self._help.get(key[0], ('gauge',))[0] == 'counter'
+                }
+            snapshots.append(snapshot)
+        return snapshots
+
+    @staticmethod
+    def merge(snapshots):
+        merged = {'counters': {}, 'histograms': {}, 'gauges': {}}
+        for snapshot in snapshots:
+            for kind in ('counters', 'gauges'):
+                for key, value in snapshot[kind].items():
+                    merged[kind][key] = merged[kind].get(key, 0) + value
+            for key, histogram in snapshot['histograms'].items():
+                total = merged['histograms'].get(key)
+                if total is None:
+                    merged['histograms'][key] = dict(
+                        histogram, counts=list(histogram['counts'])
+                    )
+                    continue
+                total['counts'] = [
+                    a + b for a, b in zip(total['counts'], histogram['counts'])
+                ]
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+        return merged
+
+    def start_writing(self, folder, interval, gauges):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write(folder, gauges())
+                except OSError:
+                    app.logger.exception('Failed to write metrics')
+        threading.Thread(target=run, daemon=True).start()
+
+    def render(self, snapshot):
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                kind, help_text = self._help.get(name, (kind, ''))
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in sorted(snapshot['counters'].items()):
+            header(name, 'counter')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), histogram in sorted(
+                snapshot['histograms'].items()):
+            header(name, 'histogram')
+            for bound, count in zip(histogram['buckets'],
+                                    histogram['counts']):
+                lines.append(f'{name}_bucket'
+                             f'{self._labels(labels, [("le", bound)])} '
+                             f'{count}')
+            lines.append(f'{name}_bucket'
+                         f'{self._labels(labels, [("le", "+Inf")])} '
+                         f'{histogram["count"]}')
+            lines.append(f'{name}_sum{self._labels(labels)} '
+                         f'{histogram["sum"]}')
+            lines.append(f'{name}_count{self._labels(labels)} '
+                         f'{histogram["count"]}')
+        for (name, labels), value in sorted(snapshot['gauges'].items()):
+            header(name, 'gauge')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+metrics = Metrics()
+metrics.describe('suxiv_request_duration_seconds', 'histogram',
+                 'Time spent handling a request.')
+metrics.describe('suxiv_request_queries', 'histogram',
+                 'SQL statements executed by a request.')
+metrics.describe('suxiv_request_sql_seconds', 'histogram',
+                 'Time a request spent executing SQL statements.')
+metrics.describe('suxiv_template_render_seconds', 'histogram',
+                 'Time spent rendering a template.')
+metrics.describe('suxiv_slow_queries_total', 'counter',
+                 'SQL statements slower than SLOW_QUERY_MS.')
+metrics.describe('suxiv_pool_connections', 'gauge',
+                 'Pooled database connections of this process.')
+metrics.describe('suxiv_pool_waiting', 'gauge',
+                 'Requests waiting for a pooled connection.')
+metrics.describe('suxiv_pool_checkouts_total', 'counter',
+                 'Connections handed out by the pool.')
+metrics.describe('suxiv_pool_wait_seconds_total', 'counter',
+                 'Time spent waiting for a pooled connection.')
+metrics.describe('suxiv_cache_hits_total', 'counter',
+                 'Lookups answered by an in-process cache.')
+metrics.describe('suxiv_cache_misses_total', 'counter',
+                 'Lookups an in-process cache could not answer.')
+metrics.describe('suxiv_event_streams', 'gauge',
+                 'Open notification streams of this process.')
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            elapsed = time.perf_counter() - started
+            if has_app_context():
+                g.query_count = g.get('query_count', 0) + 1
+                g.query_time = g.get('query_time', 0) + elapsed
+            slow_query_ms = app.config['SLOW_QUERY_MS']
+            if slow_query_ms > 0 and elapsed * 1000 >= slow_query_ms:
+                endpoint = (request.endpoint if has_request_context()
+                            else None) or '-'
+                metrics.inc('suxiv_slow_queries_total',
+                            [('endpoint', endpoint)])
+                app.logger.warning('Slow query (%.1f ms) in %s: %s',
+                                   elapsed * 1000, endpoint,
+                                   ' '.join(str(query).split()))
+
+
+class CountingDictCursor(CountingCursor, psycopg2.extras.DictCursor):
+    pass
+
+
+class Row(tuple):
+    # A tuple that can also be indexed by column name like DictRow. The
+    # names live on a class shared by every row of the same columns.
+    __slots__ = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self._index[key]
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def get(self, name, default=None):
+        index = self._index.get(name)
+        return default if index is None else tuple.__getitem__(self, index)
+
+    def keys(self):
+        return self._index.keys()
+
+
+_row_classes = {}
+
+
+def row_class(names):
+    cls = _row_classes.get(names)
+    if cls is None:
+        cls = _row_classes[names] = type('Row', (Row,), {
+            '__slots__': (),
+            '_index': {name: i for i, name in enumerate(names)},
+        })
+    return cls
+
+
+class RowCursor(CountingCursor):
+    def _row_class(self):
+        return row_class(tuple(column.name for column in self.description))
+
+    def fetchone(self):
+        row = super().fetchone()
+        return None if row is None else self._row_class()(row)
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        cls = self._row_class() if rows else None
+        return [cls(row) for row in rows]
+
+    def fetchall(self):
+        rows = super().fetchall()
+        cls = self._row_class() if rows else None
+        return [cls(row) for row in rows]
+
+    def __iter__(self):
+        # Named cursors only have a description after their first FETCH
+        cls = None
+        while True:
+            try:
+                row = next(self)
+            except StopIteration:
+                return
+            if cls is None:
+                cls = self._row_class()
+            yield cls(row)
 
 
 def connect_db():
@@ -46,14 +438,209 @@ def connect_db():
             password=os.environ.get('POSTGRESQL_PASS'),
             dbname=os.environ.get('POSTGRESQL_DB'),
         )
-    conn.cursor_factory = psycopg2.extras.DictCursor
+    conn.cursor_factory = CountingDictCursor
     return conn
 
 
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, connect, min_size, max_size, timeout, check_interval):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._cond = threading.Condition()
+        # Idle connections with the time they were returned, newest last
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._checkouts = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        for _ in range(min_size):
+            self._idle.append((connect(), time.monotonic()))
+            self._size += 1
+
+    def getconn(self):
+        started = time.monotonic()
+        with self._cond:
+            self._waiting += 1
+            try:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = started + self.timeout - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            f'no connection available in {self.timeout}s'
+                        )
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+            if self._idle:
+                conn, returned_at = self._idle.pop()
+            else:
+                conn, returned_at = None, None
+                self._size += 1
+            self._in_use += 1
+            self._checkouts += 1
+            waited = time.monotonic() - started
+            self._wait_time += waited
+            self._max_wait_time = max(self._max_wait_time, waited)
+
+        # Connecting and health checks happen outside of the lock
+        try:
+            if conn is None or not self._healthy(conn, returned_at):
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def _healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.check_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            conn.close()
+            return False
+
+    def putconn(self, conn):
+        if not conn.closed and \
+                conn.status != psycopg2.extensions.STATUS_READY:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                conn.close()
+        with self._cond:
+            self._in_use -= 1
+            if conn.closed:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                conn.close()
+            self._size -= len(self._idle)
+            self._idle = []
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'checkouts': self._checkouts,
+                'wait_time': self._wait_time,
+                'max_wait_time': self._max_wait_time,
+            }
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+# Pools inherited over fork belong to the parent. They are kept referenced
+# so that their sockets are never closed (which would end the parent's
+# sessions) nor used by the child.
+_inherited_pools = []
+
+
+def pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            if _pool is not None:
+                _inherited_pools.append(_pool)
+            _pool_pid = os.getpid()
+            _pool = ConnectionPool(
+                connect_db,
+                min_size=app.config['POOL_MIN_SIZE'],
+                max_size=app.config['POOL_MAX_SIZE'],
+                timeout=app.config['POOL_TIMEOUT'],
+                check_interval=app.config['POOL_CHECK_INTERVAL'],
+            )
+    return _pool
+
+
+class RequestConnection:
+    # `with db() as conn` blocks share one transaction per request, which is
+    # committed once the response is ready instead of at the end of each
+    # block. An exception leaving a block rolls the whole transaction back.
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.conn.rollback()
+
+
+def read_write(func):
+    # Lets a GET view write; other GET views run in READ ONLY transactions
+    func.read_write = True
+    return func
+
+
+def read_only_request():
+    if not has_request_context() or request.method not in ('GET', 'HEAD'):
+        return False
+    view = app.view_functions.get(request.endpoint)
+    return not getattr(view, 'read_write', False)
+
+
 def db():
-    if not hasattr(g, 'db'):
-        g.db = connect_db()
-    return g.db
+    if 'db' not in g:
+        try:
+            conn = pool().getconn()
+        except PoolTimeout:
+            abort(503)
+        # Sent along with the BEGIN of every transaction of the request
+        conn.readonly = read_only_request()
+        g.db = conn
+    return RequestConnection(g.db)
+
+
+@app.after_request
+def commit_db(response):
+    # Committed here rather than on teardown so that a failing commit turns
+    # into an error response. Read-only transactions are left open for
+    # streamed responses, whose rows are still being read.
+    conn = g.get('db')
+    if conn is not None and not conn.readonly and response.status_code < 500:
+        conn.commit()
+    return response
+
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        # Successful writes were committed by commit_db; anything left over
+        # belongs to a failed or error response
+        try:
+            conn.rollback()
+            conn.readonly = None
+        except psycopg2.Error:
+            conn.close()
+        pool().putconn(conn)
 
 
 def passhash(password, salt):
@@ -75,6 +662,214 @@ def validate_user_params(username, password):
         raise ValidationError('password must be at least 6 characters')
 
 
+def request_memoize(func):
+    @wraps(func)
+    def _inner(*args):
+        memo = g.setdefault('memo', {})
+        key = (func.__name__,) + args
+        if key in memo:
+            g.queries_avoided = g.get('queries_avoided', 0) + 1
+        else:
+            memo[key] = func(*args)
+        return memo[key]
+    return _inner
+
+
+def forget(func, *args):
+    memo = g.get('memo', {})
+    for key in list(memo):
+        if key[0] == func.__name__ and key[1:len(args) + 1] == args:
+            del memo[key]
+
+
+def render_template(template_name, **context):
+    started = time.perf_counter()
+    try:
+        return flask_render_template(template_name, **context)
+    finally:
+        metrics.observe('suxiv_template_render_seconds',
+                        [('template', template_name)],
+                        time.perf_counter() - started)
+
+
+def streaming():
+    # Pages stored in the page cache are rendered as a whole
+    return app.config['STREAM_LISTINGS'] and not g.get('caching_page')
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        # Flushed per chunk so that the browser can render it right away
+        yield compressor.compress(chunk.encode()) + \
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def stream_template(template_name, **context):
+    app.update_template_context(context)
+    chunks = app.jinja_env.get_template(template_name).stream(context)
+    chunks.enable_buffering()
+    response = app.response_class(mimetype='text/html')
+    # Flask-Compress would buffer the whole body to compress it
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response.headers['Content-Encoding'] = 'gzip'
+        chunks = gzip_chunks(chunks)
+    response.response = stream_with_context(chunks)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def render_listing(template_name, **context):
+    if streaming():
+        return stream_template(template_name, **context)
+    return render_template(template_name, **context)
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' not in g:
+        return response
+    labels = [
+        ('endpoint', request.endpoint or '-'),
+        ('method', request.method),
+        ('status', response.status_code),
+    ]
+    metrics.observe('suxiv_request_duration_seconds', labels,
+                    time.perf_counter() - g.request_started)
+    metrics.observe('suxiv_request_queries', labels[:1],
+                    g.get('query_count', 0),
+                    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34))
+    metrics.observe('suxiv_request_sql_seconds', labels[:1],
+                    g.get('query_time', 0))
+    return response
+
+
+@app.after_request
+def report_queries_avoided(response):
+    if app.debug:
+        response.headers['X-Queries-Avoided'] = str(
+            g.get('queries_avoided', 0)
+        )
+        response.headers['X-Query-Count'] = str(g.get('query_count', 0))
+        response.headers['X-Post-Cards'] = '{} reused, {} rendered'.format(
+            g.get('post_cards_reused', 0), g.get('post_cards_rendered', 0)
+        )
+    return response
+
+
+class LRUCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get_or_set(self, key, compute):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self._generation
+        value = compute()
+        with self._lock:
+            # Do not store a value that was read before an invalidation
+            if generation == self._generation:
+                self._entries[key] = (value, time.monotonic() + self.ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+
+class NotificationListener:
+    def __init__(self):
+        self.connected = threading.Event()
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def on(self, channel):
+        def _register(func):
+            self._handlers.setdefault(channel, []).append(func)
+            return func
+        return _register
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self.connected.clear()
+                threading.Thread(target=self._run, daemon=True).start()
+
+    def _dispatch(self, channel, payload):
+        for handler in self._handlers.get(channel, []):
+            try:
+                handler(payload)
+            except Exception:
+                app.logger.exception('Notification handler failed')
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = connect_db()
+                conn.autocommit = True
+                cursor = conn.cursor()
+                for channel in self._handlers:
+                    cursor.execute(f'LISTEN {channel}')
+                # Notifications may have been missed while disconnected
+                for channel in self._handlers:
+                    self._dispatch(channel, None)
+                self.connected.set()
+                while True:
+                    select.select([conn], [], [], 60)
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self._dispatch(notify.channel, notify.payload)
+            except psycopg2.OperationalError:
+                app.logger.exception('Lost listener connection; reconnecting')
+                self.connected.clear()
+                if conn is not None:
+                    conn.close()
+                time.sleep(1)
+
+
+notifications = NotificationListener()
+
+
+def cached(cache, key, compute):
+    # Entries are only trusted while invalidations can reach this process
+    notifications.ensure_started()
+    if not notifications.connected.is_set():
+        return compute()
+    return cache.get_or_set(key, compute)
+
+
 def authenticate(username, password):
     with db() as conn:
         cursor = conn.cursor()
@@ -84,18 +879,60 @@ def authenticate(username, password):
     return row and passhash(password, row['salt']) == row['password']
 
 
-def get_user_id_by_username(username):
+# Profiles only: the counters in users change on every follow, post and
+# favorite, and are read through calculate_count_info() instead
+user_cache = LRUCache(app.config['USER_CACHE_SIZE'],
+                      app.config['USER_CACHE_TTL'])
+user_id_cache = LRUCache(app.config['USER_CACHE_SIZE'],
+                         app.config['USER_CACHE_TTL'])
+
+
+@notifications.on('users')
+def invalidate_user(payload):
+    if not payload:
+        user_cache.clear()
+        user_id_cache.clear()
+    else:
+        user_id, username = payload.split(':', 1)
+        forget_user(int(user_id), username)
+
+
+def forget_user(user_id, username):
+    user_cache.invalidate(user_id)
+    user_id_cache.invalidate(username)
+
+
+def query_user(user_id):
     with db() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT id FROM users WHERE username = %s', (username,))
-    return cursor.fetchone()['id']
+        cursor.execute('''
+        SELECT id, username, description FROM users WHERE id = %s
+        ''', (user_id,))
+        row = cursor.fetchone()
+    return dict(row) if row else None
 
 
-def get_username_by_user_id(user_id):
+def query_user_id(username):
     with db() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT username FROM users WHERE id = %s', (user_id,))
-    return cursor.fetchone()['username']
+        cursor.execute('SELECT id FROM users WHERE username = %s', (username,))
+        row = cursor.fetchone()
+    return row['id'] if row else None
+
+
+@request_memoize
+def get_user_id_by_username(username):
+    return cached(user_id_cache, username, lambda: query_user_id(username))
+
+
+@request_memoize
+def get_username_by_user_id(user_id):
+    return get_user_by_id(user_id)['username']
+
+
+def get_user_by_username(username):
+    user_id = get_user_id_by_username(username)
+    return get_user_by_id(user_id) if user_id is not None else None
 
 
 def mime2ext(mimetype):
@@ -113,20 +950,172 @@ def helper(func):
     return func
 
 
+# Cards are keyed by everything they show that can change, so entries
+# never need to be invalidated
+post_cards = LRUCache(app.config['POST_CARD_CACHE_SIZE'], 24 * 60 * 60)
+
+
+@helper
+def post_card(post):
+    rendered = []
+
+    def render():
+        rendered.append(True)
+        return Markup(render_template('_post.html', post=post))
+
+    key = (post['id'], post['favorites_count'], post['updated_at'],
+           'username' in post)
+    card = post_cards.get_or_set(key, render)
+    if rendered:
+        g.post_cards_rendered = g.get('post_cards_rendered', 0) + 1
+    else:
+        g.post_cards_reused = g.get('post_cards_reused', 0) + 1
+    return card
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadSpool:
+    # What werkzeug writes an uploaded image into while it parses the form:
+    # a temporary file in the upload folder, hashed as it arrives. It is the
+    # only copy; store_upload() moves it to its content-addressed name and
+    # anything left over is removed when the request is closed.
+    def __init__(self, folder, max_size):
+        fd, self.path = tempfile.mkstemp(suffix='.tmp', dir=folder)
+        self.file = os.fdopen(fd, 'wb+')
+        self.digest = sha256()
+        self.size = 0
+        self.max_size = max_size
+
+    def write(self, data):
+        self.size += len(data)
+        # The rest of an oversized file is read but not kept
+        if self.size <= self.max_size:
+            self.digest.update(data)
+            self.file.write(data)
+        return len(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def close(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class SuxivRequest(Request):
+    @property
+    def max_content_length(self):
+        # Rejects oversized request bodies before they are read, leaving
+        # some room for the other form fields
+        return app.config['MAX_UPLOAD_SIZE'] + 64 * 1024
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if self.endpoint == 'upload':
+            return UploadSpool(app.config['UPLOAD_FOLDER'],
+                               app.config['MAX_UPLOAD_SIZE'])
+        return super()._get_file_stream(total_content_length, content_type,
+                                        filename, content_length)
+
+
+app.request_class = SuxivRequest
+
+
+def store_upload(upload_file, ext):
+    # Moves the spooled file to its content-addressed name unless the same
+    # content is stored already
+    spool = upload_file.stream
+    if spool.size > spool.max_size:
+        raise UploadTooLarge()
+    spool.file.flush()
+    os.fsync(spool.file.fileno())
+    filename = spool.digest.hexdigest() + ext
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if os.path.exists(filepath):
+        return filename, False
+    os.chmod(spool.path, 0o644)
+    os.replace(spool.path, filepath)
+    return filename, True
+
+
+@helper
+def derivative_name(filename, kind):
+    stem, ext = os.path.splitext(filename)
+    return f'{stem}.{kind}{ext}'
+
+
+def original_name(filename):
+    stem, ext = os.path.splitext(filename)
+    stem, kind = os.path.splitext(stem)
+    if kind[1:] in app.config['DERIVATIVE_SIZES']:
+        return stem + ext
+    return None
+
+
+def make_derivatives(folder, filename, sizes):
+    # Runs in a worker process of image_executor()
+    with Image.open(os.path.join(folder, filename)) as image:
+        for kind, size in sizes.items():
+            path = os.path.join(folder, derivative_name(filename, kind))
+            if os.path.exists(path):
+                continue
+            derivative = image.copy()
+            derivative.thumbnail(size, Image.LANCZOS)
+            derivative.save(path + '.tmp', format=image.format)
+            os.replace(path + '.tmp', path)
+
+
+_image_executor = None
+_image_executor_pid = None
+
+
+def image_executor():
+    global _image_executor, _image_executor_pid
+    if _image_executor_pid != os.getpid():
+        _image_executor = ProcessPoolExecutor(app.config['IMAGE_WORKERS'])
+        _image_executor_pid = os.getpid()
+    return _image_executor
+
+
+def _log_derivative_failure(future):
+    if future.exception() is not None:
+        app.logger.error('Failed to make image derivatives',
+                         exc_info=future.exception())
+
+
+def generate_derivatives(filename):
+    args = (app.config['UPLOAD_FOLDER'], filename,
+            app.config['DERIVATIVE_SIZES'])
+    if app.config['IMAGE_WORKERS'] > 0:
+        future = image_executor().submit(make_derivatives, *args)
+        future.add_done_callback(_log_derivative_failure)
+    else:
+        make_derivatives(*args)
+
+
 @helper
 def logged_in():
     return 'user_id' in session
 
 
+@request_memoize
+def get_user_by_id(user_id):
+    return cached(user_cache, user_id, lambda: query_user(user_id))
+
+
 @helper
 def current_user():
-    with db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE id = %s', (session.get('user_id'),))
-    return cursor.fetchone()
+    return get_user_by_id(session.get('user_id'))
 
 
 @helper
+@request_memoize
 def follows(follower_id, following_id):
     with db() as conn:
         cursor = conn.cursor()
@@ -138,6 +1127,7 @@ def follows(follower_id, following_id):
 
 
 @helper
+@request_memoize
 def favorites(user_id, post_id):
     with db() as conn:
         cursor = conn.cursor()
@@ -148,52 +1138,506 @@ def favorites(user_id, post_id):
     return cursor.fetchone() is not None
 
 
+unread_cache = LRUCache(app.config['UNREAD_CACHE_SIZE'],
+                        app.config['UNREAD_CACHE_TTL'])
+
+
+@notifications.on('unread_events')
+def invalidate_unread_count(payload):
+    if not payload:
+        unread_cache.clear()
+    else:
+        unread_cache.invalidate(int(payload))
+
+
+def query_unread_count(user_id):
+    with db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT unread_count FROM event_haveread WHERE user_id = %s
+        ''', (user_id,))
+        row = cursor.fetchone()
+    return row['unread_count'] if row else 0
+
+
+@request_memoize
+def count_unread_events(user_id):
+    return cached(unread_cache, user_id,
+                  lambda: query_unread_count(user_id))
+
+
 @helper
 def calculate_notification_count():
+    return count_unread_events(session['user_id'])
+
+
+class EventStreams:
+    def __init__(self):
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(queues) for queues in self._queues.values())
+
+    def subscribe(self, user_id):
+        messages = queue.Queue(app.config['EVENT_STREAM_BACKLOG'])
+        with self._lock:
+            self._queues.setdefault(user_id, set()).add(messages)
+        return messages
+
+    def unsubscribe(self, user_id, messages):
+        with self._lock:
+            queues = self._queues.get(user_id, set())
+            queues.discard(messages)
+            if not queues:
+                self._queues.pop(user_id, None)
+
+    def publish(self, user_id, message):
+        with self._lock:
+            queues = list(self._queues.get(user_id, ()))
+        self._put(queues, message)
+
+    def broadcast(self, message):
+        with self._lock:
+            queues = [messages for queues in self._queues.values()
+                      for messages in queues]
+        self._put(queues, message)
+
+    def _put(self, queues, message):
+        for messages in queues:
+            try:
+                messages.put_nowait(message)
+            except queue.Full:
+                # A stalled client misses summaries; its count is resent
+                # with the next change
+                pass
+
+
+event_streams = EventStreams()
+
+
+@notifications.on('unread_events')
+def push_unread_count(payload):
+    if not payload:
+        event_streams.broadcast(('unread', None))
+    else:
+        event_streams.publish(int(payload), ('unread', None))
+
+
+@notifications.on('new_events')
+def push_new_event(payload):
+    if payload:
+        receiver_id, event_id = payload.split(':')
+        event_streams.publish(int(receiver_id), ('event', int(event_id)))
+
+
+def query_event(event_id):
     with db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-        SELECT COUNT(*) AS cnt
+        SELECT
+        e.*, u.username,
+        p.title, p.path,
+        cardinality(e.actor_ids) - 1 AS others,
+        1 AS unread
         FROM events e
-        WHERE
-        receiver_id = %s
-        AND e.created_at > (
-            SELECT since FROM event_haveread
-            WHERE user_id = %s
-        )
-        ''', [session['user_id']] * 2)
-    return cursor.fetchone()['cnt'] or 0
+        INNER JOIN users u
+        ON e.invoker_id = u.id
+        LEFT JOIN posts p
+        ON e.source_id = p.id
+        WHERE e.id = %s
+        ''', (event_id,))
+    return cursor.fetchone()
 
 
 @helper
+@request_memoize
 def calculate_count_info(user_id):
     with db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-        SELECT (
-            SELECT COUNT(*) AS cnt
-            FROM relations
-            WHERE follower_id = %s
-        ) AS following_count,
-        (
-            SELECT COUNT(*) AS cnt
-            FROM relations
-            WHERE following_id = %s
-        ) AS follower_count,
-        (
-            SELECT COUNT(*) AS cnt
-            FROM favorites
-            WHERE user_id = %s
-        ) AS favorites_count,
-        (
-            SELECT COUNT(*) AS cnt
-            FROM posts
-            WHERE user_id = %s
-        ) AS posts_count
-        ''', [user_id] * 4)
+        SELECT following_count, follower_count, favorites_count, posts_count
+        FROM users
+        WHERE id = %s
+        ''', (user_id,))
     return cursor.fetchone()
 
 
+class Page:
+    def __init__(self, rows, keys, has_next, has_prev):
+        self.rows = rows
+        self.keys = keys
+        self.next_url = None
+        self.prev_url = None
+        if rows and has_next:
+            self.next_url = self._url('after', rows[-1])
+        if rows and has_prev:
+            self.prev_url = self._url('before', rows[0])
+
+    def _url(self, direction, row):
+        args = request.args.to_dict()
+        args.pop('after', None)
+        args.pop('before', None)
+        args[direction] = ','.join(str(row[key]) for key in self.keys)
+        return url_for(request.endpoint, **request.view_args, **args)
+
+
+class StreamedPage(Page):
+    # A forward page whose rows are read while it is rendered. The links
+    # are known once the rows have been iterated, which the templates do
+    # before rendering the pagination.
+    def __init__(self, cursor, keys, size, has_prev):
+        self.keys = keys
+        self._cursor = cursor
+        self._rows = iter(cursor)
+        self._size = size
+        self._has_prev = has_prev
+        self._head = next(self._rows, None)
+        self._first = None
+        self._last = None
+        self._has_next = False
+
+    @property
+    def rows(self):
+        return self
+
+    def __bool__(self):
+        return self._head is not None
+
+    def __iter__(self):
+        row, count = self._head, 0
+        while row is not None:
+            if count == self._size:
+                self._has_next = True
+                break
+            if self._first is None:
+                self._first = row
+            self._last = row
+            count += 1
+            yield row
+            row = next(self._rows, None)
+        # Otherwise it stays open until the request's transaction ends
+        self._cursor.close()
+
+    @property
+    def next_url(self):
+        if self._has_next:
+            return self._url('after', self._last)
+
+    @property
+    def prev_url(self):
+        if self._first is not None and self._has_prev:
+            return self._url('before', self._first)
+
+
+def stream_rows(query, params):
+    # A named cursor is valid for the rest of the request's transaction,
+    # which is not ended before the streamed response has been sent
+    with db() as conn:
+        cursor = conn.cursor(name='stream_rows', cursor_factory=RowCursor)
+        cursor.itersize = app.config['STREAM_BATCH_SIZE']
+        try:
+            cursor.execute(query, params)
+        except psycopg2.DataError:
+            abort(400)
+    return cursor
+
+
+def paginate(query, params, keys, descending=True, stream=False):
+    # Keyset pagination: a page boundary is given as the values of `keys` of
+    # the last (?after=) or the first (?before=) row of the adjacent page.
+    after = request.args.get('after')
+    before = request.args.get('before')
+    backward = bool(before) and not after
+    boundary = before if backward else after
+    size = app.config['PAGE_SIZE']
+
+    values = []
+    condition = 'TRUE'
+    if boundary:
+        values = boundary.split(',')
+        if len(values) != len(keys):
+            abort(400)
+        condition = '({}) {} ({})'.format(
+            ', '.join(keys),
+            '<' if descending != backward else '>',
+            ', '.join(['%s'] * len(keys)),
+        )
+    order = 'DESC' if descending != backward else 'ASC'
+    statement = f'''
+        SELECT * FROM ({query}) AS page
+        WHERE {condition}
+        ORDER BY {', '.join(f'{key} {order}' for key in keys)}
+        LIMIT {size + 1}
+    '''
+
+    if stream and not backward and streaming():
+        cursor = stream_rows(statement, list(params) + values)
+        return StreamedPage(cursor, keys, size, has_prev=bool(after))
+
+    with db() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(statement, list(params) + values)
+        except psycopg2.DataError:
+            abort(400)
+    rows = cursor.fetchall()
+    has_more = len(rows) > size
+    rows = rows[:size]
+    if backward:
+        rows.reverse()
+        return Page(rows, keys, has_next=True, has_prev=has_more)
+    return Page(rows, keys, has_next=has_more, has_prev=bool(after))
+
+
+class RankingRefresher:
+    LOCK_ID = 0x72616e6b  # pg_advisory_xact_lock key shared by all processes
+
+    def __init__(self):
+        # Top posts of posts_favorite_ranking, replaced as a whole on refresh
+        self.posts = None
+        self._pending_changes = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread_pid = None
+
+    def top(self):
+        self._ensure_started()
+        posts = self.posts
+        if posts is None:
+            posts = self.refresh()
+        return posts
+
+    def notify_change(self):
+        with self._lock:
+            self._pending_changes += 1
+            if self._pending_changes >= app.config['RANKING_REFRESH_CHANGES']:
+                self._wakeup.set()
+
+    def _ensure_started(self):
+        if app.config['RANKING_REFRESH_INTERVAL'] <= 0:
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(app.config['RANKING_REFRESH_INTERVAL'])
+            self._wakeup.clear()
+            try:
+                self.refresh()
+            except psycopg2.Error:
+                app.logger.exception('Failed to refresh the ranking')
+
+    def refresh(self):
+        with self._lock:
+            self._pending_changes = 0
+        conn = pool().getconn()
+        try:
+            with conn:
+                cursor = conn.cursor()
+                # Only one process refreshes; the others just reload the top
+                cursor.execute('SELECT pg_try_advisory_xact_lock(%s)',
+                               (self.LOCK_ID,))
+                if cursor.fetchone()[0]:
+                    cursor.execute('''
+                    SELECT ispopulated FROM pg_matviews
+                    WHERE matviewname = 'posts_favorite_ranking'
+                    ''')
+                    if cursor.fetchone()['ispopulated']:
+                        cursor.execute('''
+                        REFRESH MATERIALIZED VIEW CONCURRENTLY
+                        posts_favorite_ranking
+                        ''')
+                    else:
+                        cursor.execute('''
+                        REFRESH MATERIALIZED VIEW posts_favorite_ranking
+                        ''')
+                cursor.execute('''
+                SELECT * FROM posts_favorite_ranking
+                ORDER BY rank
+                LIMIT %s
+                ''', (app.config['RANKING_SIZE'],))
+                posts = tuple(dict(row) for row in cursor)
+        finally:
+            pool().putconn(conn)
+        self.posts = posts
+        page_cache.expire(['ranking'])
+        return posts
+
+
+ranking = RankingRefresher()
+
+
+def enqueue_event(cursor, event_type, invoker_id, source_id=None,
+                  receiver_id=None):
+    # Events are delivered by the outbox worker after the request commits
+    cursor.execute('''
+    INSERT INTO event_outbox (type, invoker_id, source_id, receiver_id)
+    VALUES (%s, %s, %s, %s)
+    ''', (event_type, invoker_id, source_id, receiver_id))
+    cursor.execute('NOTIFY event_outbox')
+
+
+def push_to_timelines(cursor, post_id):
+    # Posts of authors with many followers are not copied; index() pulls
+    # them from posts_unpushed at read time instead.
+    cursor.execute('''
+    UPDATE posts p SET timeline_pushed = true
+    FROM users u
+    WHERE p.id = %s AND u.id = p.user_id AND u.follower_count <= %s
+    RETURNING p.user_id
+    ''', (post_id, app.config['TIMELINE_FANOUT_LIMIT']))
+    row = cursor.fetchone()
+    if row is None:
+        return
+    cursor.execute('''
+    INSERT INTO timelines (user_id, post_id, author_id)
+    SELECT follower_id, %(post_id)s, following_id
+    FROM relations
+    WHERE following_id = %(author_id)s
+    ON CONFLICT DO NOTHING
+    RETURNING user_id
+    ''', {'post_id': post_id, 'author_id': row['user_id']})
+    trim_timelines(cursor, [r['user_id'] for r in cursor.fetchall()])
+
+
+def trim_timelines(cursor, user_ids):
+    # Keeps only the newest TIMELINE_SIZE entries of each timeline
+    cursor.execute('''
+    DELETE FROM timelines t
+    USING (
+        SELECT user_id, post_id,
+        row_number() OVER (PARTITION BY user_id ORDER BY post_id DESC) AS n
+        FROM timelines
+        WHERE user_id = ANY(%s)
+    ) AS old
+    WHERE t.user_id = old.user_id AND t.post_id = old.post_id AND old.n > %s
+    ''', (user_ids, app.config['TIMELINE_SIZE']))
+
+
+def coalesce_event(cursor, entry):
+    # A repeat within the window replaces the newest row of the same kind,
+    # so that the aggregate moves to the top and becomes unread again
+    cursor.execute('''
+    WITH old AS (
+        DELETE FROM events
+        WHERE id = (
+            SELECT id FROM events
+            WHERE receiver_id = %(receiver_id)s
+            AND type = %(type)s::event_type
+            AND source_id IS NOT DISTINCT FROM %(source_id)s
+            AND created_at > NOW() - make_interval(secs => %(window)s)
+            ORDER BY id DESC LIMIT 1
+            FOR UPDATE
+        )
+        RETURNING actor_ids
+    )
+    INSERT INTO events (receiver_id, type, source_id, invoker_id, actor_ids)
+    VALUES (
+        %(receiver_id)s, %(type)s, %(source_id)s, %(invoker_id)s,
+        array_append(
+            array_remove(
+                COALESCE((SELECT actor_ids FROM old), '{}'), %(invoker_id)s
+            ),
+            %(invoker_id)s
+        )
+    )
+    ''', dict(entry, window=app.config['EVENTS_COALESCE_WINDOW']))
+
+
+def dispatch_event(cursor, entry):
+    if entry['type'] == 'post':
+        cursor.execute('''
+        INSERT INTO events
+        (receiver_id, type, source_id, invoker_id, actor_ids)
+        SELECT
+        follower_id, %(type)s::event_type, %(source_id)s, %(invoker_id)s,
+        ARRAY[%(invoker_id)s]
+        FROM relations
+        WHERE following_id = %(invoker_id)s
+        ''', entry)
+        push_to_timelines(cursor, entry['source_id'])
+    elif entry['type'] == 'follow':
+        coalesce_event(cursor, entry)
+    else:
+        cursor.execute('SELECT user_id FROM posts WHERE id = %s',
+                       (entry['source_id'],))
+        post = cursor.fetchone()
+        if post is not None:
+            coalesce_event(cursor, dict(entry, receiver_id=post['user_id']))
+
+
+def withdraw_event(cursor, event_type, invoker_id, source_id=None,
+                   receiver_id=None):
+    params = {
+        'type': event_type,
+        'invoker_id': invoker_id,
+        'source_id': source_id,
+        'receiver_id': receiver_id,
+    }
+    cursor.execute('''
+    DELETE FROM event_outbox
+    WHERE type = %(type)s AND invoker_id = %(invoker_id)s
+    AND source_id IS NOT DISTINCT FROM %(source_id)s
+    AND receiver_id IS NOT DISTINCT FROM %(receiver_id)s
+    ''', params)
+    if source_id is not None:
+        target = 'source_id = %(source_id)s'
+    else:
+        target = 'receiver_id = %(receiver_id)s'
+    cursor.execute(f'''
+    UPDATE events
+    SET actor_ids = array_remove(actor_ids, %(invoker_id)s),
+    invoker_id = (array_remove(actor_ids, %(invoker_id)s))[
+        cardinality(actor_ids) - 1
+    ]
+    WHERE {target} AND type = %(type)s AND %(invoker_id)s = ANY(actor_ids)
+    ''', params)
+    cursor.execute(f'''
+    DELETE FROM events
+    WHERE {target} AND type = %(type)s AND actor_ids = '{{}}'
+    ''', params)
+
+
+def drain_outbox(conn, limit):
+    # Claiming, dispatching and deleting entries in one transaction makes
+    # delivery exactly-once; a failed entry is retried later with backoff.
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT * FROM event_outbox
+        WHERE available_at <= NOW() AND attempts < %s
+        ORDER BY id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+        ''', (app.config['OUTBOX_MAX_ATTEMPTS'], limit))
+        entries = cursor.fetchall()
+        delivered = []
+        for entry in entries:
+            cursor.execute('SAVEPOINT dispatch')
+            try:
+                dispatch_event(cursor, dict(entry))
+            except psycopg2.Error as err:
+                cursor.execute('ROLLBACK TO SAVEPOINT dispatch')
+                cursor.execute('''
+                UPDATE event_outbox
+                SET attempts = attempts + 1, last_error = %s,
+                available_at = NOW() + make_interval(secs => 2 ^ attempts)
+                WHERE id = %s
+                ''', (str(err), entry['id']))
+            else:
+                cursor.execute('RELEASE SAVEPOINT dispatch')
+                delivered.append(entry['id'])
+        cursor.execute('DELETE FROM event_outbox WHERE id = ANY(%s)',
+                       (delivered,))
+    return len(entries)
+
+
 def must_login(func):
     @wraps(func)
     def _inner(*args, **kwargs):
@@ -205,7 +1649,147 @@ def must_login(func):
     return _inner
 
 
+class PageCache:
+    # An entry is (rendered_at, expires_at, tags, mimetype, gzipped body).
+    # It is stale once any of its tags was expired after it was rendered;
+    # wall-clock times keep that comparable across processes sharing the
+    # folder.
+    def __init__(self, maxsize, folder=None):
+        self.maxsize = maxsize
+        self.folder = folder
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._expired_at = {}
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.folder, sha256(key.encode()).hexdigest())
+
+    def _fresh(self, entry):
+        rendered_at, expires_at, tags = entry[:3]
+        expired_at = max(self._expired_at.get(tag, 0) for tag in tags + ('*',))
+        return rendered_at > expired_at and expires_at > time.time()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None and self.folder:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    entry = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                entry = None
+        if entry is not None and self._fresh(entry):
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def set(self, key, entry):
+        with self._lock:
+            if not self._fresh(entry):
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        if self.folder:
+            fd, temp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f)
+            os.replace(temp_path, self._path(key))
+
+    def expire(self, tags):
+        now = time.time()
+        with self._lock:
+            for tag in tags:
+                self._expired_at[tag] = now
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expired_at.clear()
+        if self.folder:
+            for path in glob.glob(os.path.join(self.folder, '*')):
+                os.remove(path)
+
+
+page_cache = PageCache(app.config['PAGE_CACHE_SIZE'],
+                       app.config['PAGE_CACHE_FOLDER'])
+
+
+@notifications.on('page_cache')
+def expire_cached_pages(payload):
+    page_cache.expire([payload or '*'])
+
+
+def expire_pages(cursor, *tags):
+    # Expire locally right away and, once the transaction commits, again in
+    # every process (including this one, to catch pages rendered meanwhile)
+    for tag in tags:
+        cursor.execute("SELECT pg_notify('page_cache', %s)", (tag,))
+    page_cache.expire(tags)
+
+
+def expire_user_pages(cursor, user_ids, *tags):
+    cursor.execute('''
+    SELECT '@' || username AS tag FROM users WHERE id = ANY(%s)
+    ''', (list(user_ids),))
+    expire_pages(cursor, *tags, *(row['tag'] for row in cursor.fetchall()))
+
+
+def expire_favorite_pages(cursor, post_id):
+    cursor.execute('SELECT user_id FROM posts WHERE id = %s', (post_id,))
+    owners = [row['user_id'] for row in cursor.fetchall()]
+    expire_user_pages(cursor, [session['user_id']] + owners, 'posts')
+
+
+def serve_cached_page(entry):
+    body = entry[4]
+    response = app.response_class(mimetype=entry[3])
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        body = gzip.decompress(body)
+    response.set_data(body)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def cache_page(ttl, *tags):
+    # Tags may refer to view arguments, e.g. '@{username}'
+    def _decorator(func):
+        @wraps(func)
+        def _inner(*args, **kwargs):
+            notifications.ensure_started()
+            if ('user_id' in session or '_flashes' in session or
+                    not notifications.connected.is_set()):
+                return func(*args, **kwargs)
+            key = request.full_path
+            entry = page_cache.get(key)
+            if entry is None:
+                rendered_at = time.time()
+                g.caching_page = True
+                response = app.make_response(func(*args, **kwargs))
+                if response.status_code != 200 or session.modified:
+                    return response
+                entry = (
+                    rendered_at, rendered_at + ttl,
+                    tuple(tag.format(**kwargs) for tag in tags),
+                    response.mimetype,
+                    gzip.compress(response.get_data()),
+                )
+                page_cache.set(key, entry)
+            return serve_cached_page(entry)
+        return _inner
+    return _decorator
+
+
 @app.route('/')
+@cache_page(30, 'posts')
 def index():
     with db() as conn:
         cursor = conn.cursor()
@@ -222,12 +1806,19 @@ def index():
             cursor.execute('''
                 SELECT *
                 FROM posts_with_full_info
-                WHERE user_id IN (
-                    SELECT following_id FROM relations
-                    WHERE follower_id = %s
+                WHERE id IN (
+                    (SELECT post_id FROM timelines
+                     WHERE user_id = %(user_id)s
+                     ORDER BY post_id DESC LIMIT 8)
+                    UNION ALL
+                    (SELECT p.id FROM relations r
+                     JOIN posts p ON p.user_id = r.following_id
+                     WHERE r.follower_id = %(user_id)s
+                     AND NOT p.timeline_pushed
+                     ORDER BY p.id DESC LIMIT 8)
                 )
                 ORDER BY id DESC LIMIT 8
-            ''', (session['user_id'],))
+            ''', {'user_id': session['user_id']})
         posts_following = cursor.fetchall()
     else:
         posts_following = []
@@ -298,6 +1889,7 @@ def register_user():
                         f'Unknown error: {err.pgerror}', 'error'
                     )
                 return redirect(url_for('register_user'))
+        forget_user(lastrowid, username)
         session['user_id'] = lastrowid
         flash('Registration succeeded', 'info')
         return redirect(url_for('mypage'))
@@ -306,31 +1898,22 @@ def register_user():
 
 
 @app.route('/@<string:username>')
+@cache_page(60, '@{username}')
 def userpage(username):
-    with db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT id AS user_id, username, description
-        FROM users
-        WHERE username = %s
-        ''', (username,))
-        user = cursor.fetchone()
-
+    user = get_user_by_username(username)
     if user is None:
         abort(404)
 
     # Fetch user's post
-    with db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT *
-            FROM posts_with_full_info
-            WHERE user_id = %s
-            ORDER BY id DESC
-        ''', (user['user_id'],))
-        posts = cursor.fetchall()
+    page = paginate('''
+        SELECT *
+        FROM posts_with_full_info
+        WHERE user_id = %s
+    ''', (user['id'],), ['id'], stream=True)
 
-    return render_template('user.html', **user, posts=posts)
+    return render_listing('user.html', user_id=user['id'],
+                          username=username, description=user['description'],
+                          posts=page.rows, page=page)
 
 
 @app.route('/following')
@@ -342,24 +1925,20 @@ def following():
 
 @app.route('/@<string:username>/following')
 def users_following(username):
-    with db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT id AS user_id, description FROM users
-        WHERE username = %s
-        ''', (username,))
-        user = cursor.fetchone()
-        cursor.execute('''
-        SELECT u.* FROM relations r
+    user = get_user_by_username(username)
+    if user is None:
+        abort(404)
+
+    page = paginate('''
+        SELECT u.id, u.username, u.description, r.created_at AS followed_at
+        FROM relations r
         INNER JOIN users u
-        ON u.id = r.following_id AND r.follower_id = (
-            SELECT id FROM users
-            WHERE username = %s
-        )
-        ORDER BY created_at DESC
-        ''', (username,))
-    return render_template('following.html', users=cursor.fetchall(),
-                           username=username, **user)
+        ON u.id = r.following_id
+        WHERE r.follower_id = %s
+    ''', (user['id'],), ['followed_at', 'id'])
+    return render_template('following.html', users=page.rows, page=page,
+                           user_id=user['id'], username=username,
+                           description=user['description'])
 
 
 @app.route('/follower')
@@ -371,24 +1950,20 @@ def follower():
 
 @app.route('/@<string:username>/follower')
 def users_follower(username):
-    with db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT id AS user_id, description FROM users
-        WHERE username = %s
-        ''', (username,))
-        user = cursor.fetchone()
-        cursor.execute('''
-        SELECT u.* FROM relations r
+    user = get_user_by_username(username)
+    if user is None:
+        abort(404)
+
+    page = paginate('''
+        SELECT u.id, u.username, u.description, r.created_at AS followed_at
+        FROM relations r
         INNER JOIN users u
-        ON u.id = r.follower_id AND r.following_id = (
-            SELECT id FROM users
-            WHERE username = %s
-        )
-        ORDER BY created_at DESC
-        ''', (username,))
-    return render_template('follower.html', users=cursor.fetchall(),
-                           username=username, **user)
+        ON u.id = r.follower_id
+        WHERE r.following_id = %s
+    ''', (user['id'],), ['followed_at', 'id'])
+    return render_template('follower.html', users=page.rows, page=page,
+                           user_id=user['id'], username=username,
+                           description=user['description'])
 
 
 @app.route('/follow', methods=['POST'])
@@ -401,23 +1976,28 @@ def follow():
             cursor.execute('''
             INSERT INTO relations (follower_id, following_id)
             VALUES (%s, (SELECT id FROM users WHERE username = %s))
+            RETURNING following_id
             ''', (session['user_id'], username))
+            following_id = cursor.fetchone()['following_id']
             cursor.execute('''
-            INSERT INTO events
-            (receiver_id, type, source_id, invoker_id)
-            SELECT
-                id AS receiver_id,
-                event_type('follow') AS type,
-                NULL AS source_id,
-                %s AS invoker_id
-            FROM users
-            WHERE username = %s
-            ''', (session['user_id'], username))
+            INSERT INTO timelines (user_id, post_id, author_id)
+            SELECT %s, id, user_id
+            FROM posts
+            WHERE user_id = %s AND timeline_pushed
+            ORDER BY id DESC LIMIT %s
+            ''', (session['user_id'], following_id,
+                  app.config['TIMELINE_SIZE']))
+            trim_timelines(cursor, [session['user_id']])
+            enqueue_event(cursor, 'follow', session['user_id'],
+                          receiver_id=following_id)
+            expire_user_pages(cursor, [session['user_id'], following_id])
         except psycopg2.Error as err:
             if err.pgcode == psycopg2.errorcodes.NOT_NULL_VIOLATION:
                 abort(400)
             else:
                 raise err
+    forget(follows, session['user_id'])
+    forget(calculate_count_info)
     flash('Follow successful', 'info')
     return redirect(url_for('userpage', username=username))
 
@@ -432,13 +2012,20 @@ def unfollow():
         DELETE FROM relations
         WHERE follower_id = %s AND
         following_id = (SELECT id FROM users WHERE username = %s)
+        RETURNING following_id
         ''', (session['user_id'], username))
-        cursor.execute('''
-        DELETE FROM events
-        WHERE type = 'follow' AND
-        receiver_id = (SELECT id FROM users WHERE username = %s)
-        AND invoker_id = %s
-        ''', (username, session['user_id']))
+        relation = cursor.fetchone()
+        if relation is not None:
+            cursor.execute('''
+            DELETE FROM timelines
+            WHERE user_id = %s AND author_id = %s
+            ''', (session['user_id'], relation['following_id']))
+            withdraw_event(cursor, 'follow', session['user_id'],
+                           receiver_id=relation['following_id'])
+            expire_user_pages(cursor, [session['user_id'],
+                                       relation['following_id']])
+    forget(follows, session['user_id'])
+    forget(calculate_count_info)
     flash('Unfollow successful', 'info')
     return redirect(url_for('userpage', username=username))
 
@@ -462,6 +2049,9 @@ def setting():
                 description = %s, updated_at = NOW()
                 WHERE id = %s
             ''', (description, session['user_id'],))
+            expire_user_pages(cursor, [session['user_id']])
+        user_cache.invalidate(session['user_id'])
+        forget(get_user_by_id, session['user_id'])
         flash('Settings changed', 'info')
         return redirect(url_for('setting'))
     else:
@@ -469,6 +2059,19 @@ def setting():
         return render_template('setting.html', user=user)
 
 
+def reject_large_upload():
+    flash('You cannot upload the file; it must be smaller than '
+          f'{app.config["MAX_UPLOAD_SIZE"] // 1024} KiB', 'error')
+    return redirect(url_for('upload'))
+
+
+@app.errorhandler(413)
+def request_too_large(error):
+    if request.endpoint == 'upload':
+        return reject_large_upload()
+    return error
+
+
 @app.route('/upload', methods=['GET', 'POST'])
 @must_login
 def upload():
@@ -484,10 +2087,15 @@ def upload():
             flash('You cannot upload the file; '
                   'only JPEG / PNG / GIF is allowed', 'error')
             return redirect(url_for('upload'))
-        ext = mime2ext(upload_file.mimetype)
-        filedata = upload_file.read()
-        filename = sha256(filedata).hexdigest() + ext
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        try:
+            filename, created = store_upload(
+                upload_file, mime2ext(upload_file.mimetype)
+            )
+        except UploadTooLarge:
+            return reject_large_upload()
+        if created:
+            generate_derivatives(filename)
+
         with db() as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -495,65 +2103,78 @@ def upload():
                  VALUES (%s, %s, %s, %s) RETURNING id
             ''', (session['user_id'], title, description, filename))
             new_post_id = cursor.fetchone()[0]
-            cursor.execute('''
-            INSERT INTO events (receiver_id, type, source_id, invoker_id)
-            SELECT
-                follower_id AS receiver_id,
-                event_type('post') AS type,
-                %s AS source_id,
-                %s AS invoker_id
-            FROM relations
-            WHERE following_id = %s
-            ''', (new_post_id, session['user_id'], session['user_id']))
-            with open(filepath, 'wb') as fin:
-                fin.write(filedata)
+            enqueue_event(cursor, 'post', session['user_id'],
+                          source_id=new_post_id)
+            cursor.execute('NOTIFY search_posts')
+            expire_user_pages(cursor, [session['user_id']], 'posts')
+        search_cache.clear()
+        forget(calculate_count_info, session['user_id'])
         return redirect(url_for('show_post', post_id=new_post_id))
     else:
         return render_template('upload.html')
 
 
 @app.route('/posts')
+@cache_page(30, 'posts')
 def list_posts():
-    with db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT *
-            FROM posts_with_full_info
-            ORDER BY id DESC
-        ''')
-    posts = cursor.fetchall()
-    return render_template('posts.html', posts=posts)
+    page = paginate('''
+        SELECT *
+        FROM posts_with_full_info
+    ''', (), ['id'], stream=True)
+    return render_listing('posts.html', posts=page.rows, page=page)
+
+
+search_cache = LRUCache(app.config['SEARCH_CACHE_SIZE'],
+                        app.config['SEARCH_CACHE_TTL'])
+
+
+@notifications.on('search_posts')
+def invalidate_search_results(payload):
+    search_cache.clear()
+
+
+def search_page(query):
+    # The score is rounded so that it round-trips exactly through ?after=
+    return paginate('''
+        SELECT *,
+        round(bigm_similarity(title || ' ' || description, %s)::numeric, 6)
+        AS score
+        FROM posts_with_full_info
+        WHERE (title || ' ' || description) LIKE likequery(%s)
+    ''', [query] * 2, ['score', 'id'])
 
 
 @app.route('/posts/search')
 def search_posts():
-    query = request.args.get('query', '')
+    query = ' '.join(request.args.get('query', '').split())
     if not query:
         return redirect(url_for('list_posts'))
 
-    with db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT *
-            FROM posts_with_full_info
-            WHERE title LIKE likequery(%s)
-            OR description LIKE likequery(%s)
-            ORDER BY id DESC
-        ''', [query] * 2)
-    posts = cursor.fetchall()
-    return render_template('posts.html', posts=posts, query=query)
+    key = (query, request.args.get('after'), request.args.get('before'))
+    page = cached(search_cache, key, lambda: search_page(query))
+    return render_template('posts.html', posts=page.rows, page=page,
+                           query=query)
 
 
 @app.route('/posts/ranking')
+@cache_page(60, 'ranking')
 def posts_ranking():
-    with db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT *
-            FROM posts_favorite_ranking
-        ''')
-    posts = cursor.fetchall()
-    return render_template('ranking.html', posts=posts)
+    posts = ranking.top()
+    size = app.config['PAGE_SIZE']
+    # Ranks are contiguous from 1, so the post ranked `r` is posts[r - 1]
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    if any(rank is not None and rank < 1 for rank in (after, before)):
+        abort(400)
+    if before and not after:
+        start = max(before - 1 - size, 0)
+        page = Page(list(posts[start:before - 1]), ['rank'],
+                    has_next=True, has_prev=start > 0)
+    else:
+        start = after or 0
+        page = Page(list(posts[start:start + size]), ['rank'],
+                    has_next=start + size < len(posts), has_prev=start > 0)
+    return render_template('ranking.html', posts=page.rows, page=page)
 
 
 @app.route('/post/<int:post_id>')
@@ -561,7 +2182,8 @@ def show_post(post_id):
     with db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT p.id, p.title, p.description, p.path, p.user_id, u.username
+            SELECT p.id, p.title, p.description, p.path, p.user_id,
+            p.favorites_count, u.username
             FROM posts p
             INNER JOIN users u
             ON p.user_id = u.id
@@ -572,11 +2194,6 @@ def show_post(post_id):
             abort(404)
 
         data = dict(row)
-        cursor.execute(
-            'SELECT COUNT(*) AS cnt FROM favorites WHERE post_id = %s',
-            (post_id,)
-        )
-        data['favorites_count'] = cursor.fetchone()['cnt']
         cursor.execute('''
             SELECT c.content, c.created_at, u.username
             FROM comments c
@@ -600,6 +2217,11 @@ def delete_post(post_id):
             abort(403)
 
         cursor.execute('DELETE FROM posts WHERE id = %s', (post_id,))
+        cursor.execute('NOTIFY search_posts')
+        expire_user_pages(cursor, [session['user_id']], 'posts')
+    search_cache.clear()
+    forget(calculate_count_info)
+    forget(favorites)
 
     flash('Delete successful', 'info')
     return redirect(url_for('index'))
@@ -607,7 +2229,24 @@ def delete_post(post_id):
 
 @app.route('/uploads/<path:filename>')
 def image_from_uploads(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    folder = app.config['UPLOAD_FOLDER']
+    original = original_name(filename)
+    if original and not os.path.exists(safe_join(folder, filename)):
+        # The derivative is not generated yet; serve the original meanwhile
+        response = send_from_directory(folder, original)
+        response.cache_control.no_cache = True
+        return response
+
+    # Filenames are content hashes, so a response never goes stale
+    response = send_from_directory(folder, filename, conditional=False,
+                                   add_etags=False,
+                                   cache_timeout=UPLOAD_MAX_AGE)
+    response.set_etag(os.path.splitext(filename)[0])
+    response.headers['Cache-Control'] = \
+        f'public, max-age={UPLOAD_MAX_AGE}, immutable'
+    return response.make_conditional(
+        request, accept_ranges=True, complete_length=response.content_length
+    )
 
 
 @app.route('/post/<int:post_id>/comment', methods=['POST'])
@@ -622,16 +2261,8 @@ def post_comment(post_id):
             (post_id, user_id, content) VALUES
             (%s, %s, %s)
             ''', (post_id, session['user_id'], content))
-            cursor.execute('''
-            INSERT INTO events (receiver_id, type, source_id, invoker_id)
-            SELECT
-                user_id AS receiver_id,
-                event_type('comment') AS type,
-                %s AS source_id,
-                %s AS invoker_id
-            FROM posts
-            WHERE id = %s
-            ''', (post_id, session['user_id'], post_id))
+            enqueue_event(cursor, 'comment', session['user_id'],
+                          source_id=post_id)
         except psycopg2.Error as err:
             if err.pgcode == psycopg2.errorcodes.FOREIGN_KEY_VIOLATION:
                 abort(400)
@@ -649,27 +2280,20 @@ def list_my_favorite():
 @must_login
 @app.route('/@<string:username>/favorites')
 def list_favorite(username):
-    with db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT id AS user_id, description FROM users
-        WHERE username = %s
-        ''', (username,))
-        user = cursor.fetchone()
-        cursor.execute('''
-        SELECT p.*, f.created_at
+    user = get_user_by_username(username)
+    if user is None:
+        abort(404)
+
+    page = paginate('''
+        SELECT p.*, f.created_at AS favorited_at
         FROM posts_with_full_info p
         INNER JOIN favorites f
-        ON f.user_id = (
-            SELECT id FROM users
-            WHERE username = %s
-        )
-        AND f.post_id = p.id
-        ORDER BY f.created_at DESC
-        ''', (username,))
-    posts = cursor.fetchall()
-    return render_template('favorites.html', posts=posts, username=username,
-                           **user)
+        ON f.post_id = p.id
+        WHERE f.user_id = %s
+    ''', (user['id'],), ['favorited_at', 'id'])
+    return render_template('favorites.html', posts=page.rows, page=page,
+                           user_id=user['id'], username=username,
+                           description=user['description'])
 
 
 @app.route('/favorite/<int:post_id>', methods=['POST'])
@@ -682,21 +2306,17 @@ def create_favorite(post_id):
             INSERT INTO favorites (user_id, post_id)
             VALUES (%s, %s)
             ''', (session['user_id'], post_id,))
-            cursor.execute('''
-            INSERT INTO events (receiver_id, type, source_id, invoker_id)
-            SELECT
-                user_id AS receiver_id,
-                event_type('favorite') AS type,
-                id AS source_id,
-                %s AS invoker_id
-            FROM posts
-            WHERE id = %s
-            ''', (session['user_id'], post_id))
+            enqueue_event(cursor, 'favorite', session['user_id'],
+                          source_id=post_id)
+            expire_favorite_pages(cursor, post_id)
         except psycopg2.Error as err:
             if err.pgcode == psycopg2.errorcodes.FOREIGN_KEY_VIOLATION:
                 abort(400)
             else:
                 raise err
+    forget(favorites, session['user_id'], post_id)
+    forget(calculate_count_info, session['user_id'])
+    ranking.notify_change()
     return redirect(url_for('show_post', post_id=post_id))
 
 
@@ -709,22 +2329,24 @@ def delete_favorite(post_id):
         DELETE FROM favorites
         WHERE user_id = %s AND post_id = %s
         ''', (session['user_id'], post_id,))
-        cursor.execute('''
-        DELETE FROM events
-        WHERE invoker_id = %s AND source_id = %s AND type = 'favorite'
-        ''', (session['user_id'], post_id))
+        withdraw_event(cursor, 'favorite', session['user_id'],
+                       source_id=post_id)
+        expire_favorite_pages(cursor, post_id)
+    forget(favorites, session['user_id'], post_id)
+    forget(calculate_count_info, session['user_id'])
+    ranking.notify_change()
     return redirect(url_for('show_post', post_id=post_id))
 
 
 @app.route('/events')
 @must_login
+@read_write
 def list_events():
-    with db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
+    page = paginate('''
         SELECT
         e.*, u.username,
         p.title, p.path,
+        cardinality(e.actor_ids) - 1 AS others,
         (e.created_at > eh.since)::int AS unread
         FROM events e
         INNER JOIN event_haveread eh
@@ -734,15 +2356,393 @@ def list_events():
         LEFT JOIN posts p
         ON e.source_id = p.id
         WHERE receiver_id = %s
-        ORDER BY id DESC
-        ''', (session['user_id'],))
-        events = cursor.fetchall()
-        if events and bool(events[0]['unread']):
+    ''', (session['user_id'],), ['id'])
+    events = page.rows
+    if events and bool(events[0]['unread']):
+        with db() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
             UPDATE event_haveread
-            SET since = NOW() WHERE user_id = %s
+            SET since = NOW(), unread_count = 0 WHERE user_id = %s
             ''', (session['user_id'],))
-    return render_template('events.html', events=events)
+            cursor.execute("SELECT pg_notify('unread_events', %s)",
+                           (str(session['user_id']),))
+        unread_cache.invalidate(session['user_id'])
+        forget(count_unread_events, session['user_id'])
+    return render_template('events.html', events=events, page=page)
+
+
+def server_sent_event(event, data):
+    lines = ''.join(f'data: {line}\n' for line in str(data).splitlines())
+    return f'event: {event}\n{lines}\n'
+
+
+@app.route('/events/stream')
+@must_login
+def stream_events():
+    if not app.config['EVENT_STREAMS']:
+        abort(404)
+    user_id = session['user_id']
+    notifications.ensure_started()
+    messages = event_streams.subscribe(user_id)
+
+    def generate():
+        # Every message is handled in its own app context, so that an idle
+        # stream holds no pooled connection
+        try:
+            message = ('unread', None)
+            while True:
+                if message is None:
+                    yield ': keepalive\n\n'
+                elif message[0] == 'unread':
+                    with app.app_context():
+                        count = cached(unread_cache, user_id,
+                                       lambda: query_unread_count(user_id))
+                    yield server_sent_event('unread', count)
+                else:
+                    with app.app_context():
+                        event = query_event(message[1])
+                        html = event and render_template('_event.html',
+                                                         event=event)
+                    if html:
+                        yield server_sent_event('event', html)
+                try:
+                    message = messages.get(
+                        timeout=app.config['EVENT_STREAM_KEEPALIVE']
+                    )
+                except queue.Empty:
+                    message = None
+        finally:
+            event_streams.unsubscribe(user_id, messages)
+
+    return app.response_class(stream_with_context(generate()),
+                              mimetype='text/event-stream',
+                              headers={
+                                  'Cache-Control': 'no-cache',
+                                  'X-Accel-Buffering': 'no',
+                              })
+
+
+def process_gauges():
+    gauges = []
+    if _pool is not None:
+        stats = _pool.stats()
+        gauges += [
+            ('suxiv_pool_connections', [('state', 'in_use')],
+             stats['in_use']),
+            ('suxiv_pool_connections', [('state', 'idle')], stats['idle']),
+            ('suxiv_pool_waiting', [], stats['waiting']),
+            ('suxiv_pool_checkouts_total', [], stats['checkouts']),
+            ('suxiv_pool_wait_seconds_total', [], stats['wait_time']),
+        ]
+    gauges.append(('suxiv_event_streams', [], len(event_streams)))
+    caches = {
+        'page': page_cache,
+        'post_card': post_cards,
+        'search': search_cache,
+        'unread': unread_cache,
+        'user': user_cache,
+        'user_id': user_id_cache,
+    }
+    for name, cache in caches.items():
+        gauges += [
+            ('suxiv_cache_hits_total', [('cache', name)], cache.hits),
+            ('suxiv_cache_misses_total', [('cache', name)], cache.misses),
+        ]
+    return gauges
+
+
+@app.route('/metrics')
+def show_metrics():
+    folder = app.config['METRICS_FOLDER']
+    if folder:
+        metrics.write(folder, process_gauges())
+        snapshot = metrics.merge(metrics.read(folder))
+    else:
+        snapshot = metrics.snapshot(process_gauges())
+    return app.response_class(metrics.render(snapshot),
+                              mimetype='text/plain; version=0.0.4')
+
+
+def reconcile_counters(conn):
+    cursor = conn.cursor()
+    # Block writers of the counted tables so that counts are consistent
+    cursor.execute('''
+    LOCK TABLE favorites, relations, posts, events, event_haveread
+    IN SHARE ROW EXCLUSIVE MODE
+    ''')
+    cursor.execute('''
+    UPDATE posts p
+    SET favorites_count = c.cnt
+    FROM (
+        SELECT p.id, COUNT(f.user_id) AS cnt
+        FROM posts p
+        LEFT JOIN favorites f
+        ON f.post_id = p.id
+        GROUP BY p.id
+    ) c
+    WHERE p.id = c.id AND p.favorites_count <> c.cnt
+    ''')
+    posts_fixed = cursor.rowcount
+    cursor.execute('''
+    UPDATE users u
+    SET posts_count = c.posts_count,
+        following_count = c.following_count,
+        follower_count = c.follower_count,
+        favorites_count = c.favorites_count
+    FROM (
+        SELECT
+        id,
+        (SELECT COUNT(*) FROM posts WHERE user_id = u.id) AS posts_count,
+        (
+            SELECT COUNT(*) FROM relations WHERE follower_id = u.id
+        ) AS following_count,
+        (
+            SELECT COUNT(*) FROM relations WHERE following_id = u.id
+        ) AS follower_count,
+        (
+            SELECT COUNT(*) FROM favorites WHERE user_id = u.id
+        ) AS favorites_count
+        FROM users u
+    ) c
+    WHERE u.id = c.id AND (
+        u.posts_count, u.following_count, u.follower_count, u.favorites_count
+    ) <> (
+        c.posts_count, c.following_count, c.follower_count, c.favorites_count
+    )
+    ''')
+    users_fixed = cursor.rowcount
+    return posts_fixed, users_fixed, reconcile_unread_counts(cursor)
+
+
+def reconcile_unread_counts(cursor):
+    cursor.execute('''
+    UPDATE event_haveread eh
+    SET unread_count = c.cnt
+    FROM (
+        SELECT eh.user_id, COUNT(e.id) AS cnt
+        FROM event_haveread eh
+        LEFT JOIN events e
+        ON e.receiver_id = eh.user_id AND e.created_at > eh.since
+        GROUP BY eh.user_id
+    ) c
+    WHERE eh.user_id = c.user_id AND eh.unread_count <> c.cnt
+    ''')
+    fixed = cursor.rowcount
+    if fixed:
+        cursor.execute('NOTIFY unread_events')
+    return fixed
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recompute the denormalized counters and unread event counts."""
+    with connect_db() as conn:
+        posts_fixed, users_fixed, unread_fixed = reconcile_counters(conn)
+    click.echo(f'Fixed counters of {posts_fixed} posts, {users_fixed} users, '
+               f'{unread_fixed} unread counts')
+
+
+@app.cli.command('backfill-derivatives')
+def backfill_derivatives_command():
+    """Generate missing image derivatives of existing uploads."""
+    folder = app.config['UPLOAD_FOLDER']
+    sizes = app.config['DERIVATIVE_SIZES']
+    filenames = [
+        filename for filename in sorted(os.listdir(folder))
+        if not filename.endswith('.tmp') and original_name(filename) is None
+        and not all(
+            os.path.exists(
+                os.path.join(folder, derivative_name(filename, kind))
+            )
+            for kind in sizes
+        )
+    ]
+    with ProcessPoolExecutor(app.config['IMAGE_WORKERS'] or None) as executor:
+        futures = [
+            executor.submit(make_derivatives, folder, filename, sizes)
+            for filename in filenames
+        ]
+        for filename, future in zip(filenames, futures):
+            if future.exception() is not None:
+                click.echo(f'{filename}: {future.exception()}', err=True)
+    click.echo(f'Generated derivatives of {len(filenames)} uploads')
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def create_events_partition(cursor, month):
+    name = f'events_p{month:%Y%m}'
+    cursor.execute('SELECT to_regclass(%s) AS oid', (name,))
+    if cursor.fetchone()['oid'] is not None:
+        return False
+    bounds = (str(month), str(add_months(month, 1)))
+    # Rows that landed in the default partition must move before attaching.
+    # They move between detached tables so that the events triggers, which
+    # would notify and recount them, fire for neither the delete nor the
+    # insert; attaching clones the triggers and indexes onto the month.
+    cursor.execute('ALTER TABLE events DETACH PARTITION events_default')
+    cursor.execute(f'''
+    CREATE TABLE {name}
+    (LIKE events INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+    ''')
+    cursor.execute(f'''
+    WITH moved AS (
+        DELETE FROM events_default
+        WHERE created_at >= %s AND created_at < %s
+        RETURNING *
+    )
+    INSERT INTO {name} SELECT * FROM moved
+    ''', bounds)
+    cursor.execute(f'''
+    ALTER TABLE events ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)
+    ''', bounds)
+    cursor.execute('''
+    ALTER TABLE events ATTACH PARTITION events_default DEFAULT
+    ''')
+    return True
+
+
+def expire_events_partitions(cursor, cutoff, archive):
+    cursor.execute('''
+    SELECT c.relname
+    FROM pg_inherits i
+    INNER JOIN pg_class c
+    ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'events'::regclass AND c.relname ~ '^events_p\\d{6}$'
+    ORDER BY c.relname
+    ''')
+    expired = []
+    for row in cursor.fetchall():
+        name = row['relname']
+        month = date(int(name[8:12]), int(name[12:14]), 1)
+        if add_months(month, 1) <= cutoff:
+            cursor.execute(f'ALTER TABLE events DETACH PARTITION {name}')
+            if not archive:
+                cursor.execute(f'DROP TABLE {name}')
+            expired.append(name)
+    cursor.execute('DELETE FROM events_default WHERE created_at < %s',
+                   (str(cutoff),))
+    return expired
+
+
+@app.cli.command('events-maintenance')
+@click.option('--archive', is_flag=True,
+              help='Keep expired partitions as standalone tables.')
+def events_maintenance_command(archive):
+    """Create upcoming events partitions and expire old ones."""
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT CURRENT_DATE AS today')
+        today = cursor.fetchone()['today']
+        created = 0
+        for i in range(app.config['EVENTS_PARTITIONS_AHEAD'] + 1):
+            month = add_months(today.replace(day=1), i)
+            created += create_events_partition(cursor, month)
+        cutoff = today - timedelta(days=app.config['EVENTS_RETENTION_DAYS'])
+        expired = expire_events_partitions(cursor, cutoff, archive)
+        reconcile_unread_counts(cursor)
+    click.echo(f'Created {created} partitions')
+    for name in expired:
+        click.echo(f'{"Archived" if archive else "Dropped"} {name}')
+
+
+@app.cli.command('outbox-worker')
+def outbox_worker_command():
+    """Deliver queued notification events until terminated."""
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    batch_size = app.config['OUTBOX_BATCH_SIZE']
+    conn = listener = None
+    while not stopping.is_set():
+        try:
+            if conn is None:
+                conn = connect_db()
+                listener = connect_db()
+                listener.autocommit = True
+                listener.cursor().execute('LISTEN event_outbox')
+            if drain_outbox(conn, batch_size) < batch_size:
+                # Sleep until a request enqueues an event
+                select.select([listener], [], [],
+                              app.config['OUTBOX_POLL_INTERVAL'])
+                listener.poll()
+                listener.notifies.clear()
+        except psycopg2.OperationalError:
+            app.logger.exception('Lost connection; reconnecting')
+            for connection in (conn, listener):
+                if connection is not None:
+                    connection.close()
+            conn = listener = None
+            time.sleep(app.config['OUTBOX_POLL_INTERVAL'])
+    for connection in (conn, listener):
+        if connection is not None:
+            connection.close()
+
+
+MIGRATIONS_LOCK_ID = 0x6d696772  # pg_advisory_lock key of `flask migrate`
+# Marks a migration that must run outside a transaction, statement by
+# statement (e.g. CREATE INDEX CONCURRENTLY)
+NO_TRANSACTION = '-- no-transaction'
+
+
+def pending_migrations(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version character varying(255) PRIMARY KEY,
+        applied_at timestamp without time zone DEFAULT now() NOT NULL
+    )
+    ''')
+    cursor.execute('SELECT version FROM schema_migrations')
+    applied = {row['version'] for row in cursor.fetchall()}
+    paths = sorted(glob.glob(os.path.join(app.root_path, 'migrations',
+                                          '*.sql')))
+    return [
+        (os.path.basename(path)[:-len('.sql')], path) for path in paths
+        if os.path.basename(path)[:-len('.sql')] not in applied
+    ]
+
+
+def apply_migration(conn, version, path):
+    with open(path) as f:
+        sql = f.read()
+    cursor = conn.cursor()
+    if sql.startswith(NO_TRANSACTION):
+        # Each statement must be idempotent, as a failure part way leaves
+        # the earlier ones applied
+        conn.autocommit = True
+        for statement in re.split(r';\s*$', sql, flags=re.MULTILINE):
+            if re.sub(r'--.*$', '', statement, flags=re.MULTILINE).strip():
+                cursor.execute(statement)
+        cursor.execute('INSERT INTO schema_migrations (version) VALUES (%s)',
+                       (version,))
+    else:
+        conn.autocommit = False
+        with conn:
+            cursor.execute(sql)
+            cursor.execute('''
+            INSERT INTO schema_migrations (version) VALUES (%s)
+            ''', (version,))
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending migrations in migrations/ in order."""
+    conn = connect_db()
+    try:
+        conn.autocommit = True
+        cursor = conn.cursor()
+        # Runs concurrently started elsewhere wait instead of racing
+        cursor.execute('SELECT pg_advisory_lock(%s)', (MIGRATIONS_LOCK_ID,))
+        migrations = pending_migrations(cursor)
+        for version, path in migrations:
+            click.echo(f'Applying {version}')
+            apply_migration(conn, version, path)
+        click.echo(f'Applied {len(migrations)} migrations')
+    finally:
+        conn.close()
 
 
 def initialize():
@@ -750,18 +2750,126 @@ def initialize():
         cursor = conn.cursor()
         cursor.execute('''
         TRUNCATE
-        relations, comments, favorites, posts, users, events, event_haveread
+        relations, comments, favorites, posts, users, events, event_haveread,
+        event_outbox, timelines
         RESTART IDENTITY CASCADE
         ''')
 
     for path in glob.glob(os.path.join(app.config['UPLOAD_FOLDER'], '*')):
         os.remove(path)
 
+    ranking.posts = None
+    unread_cache.clear()
+    user_cache.clear()
+    user_id_cache.clear()
+    search_cache.clear()
+    page_cache.clear()
+    post_cards.clear()
+
+
+def shutdown_worker():
+    if app.config['METRICS_FOLDER']:
+        metrics.write(app.config['METRICS_FOLDER'], process_gauges())
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.closeall()
+    if _image_executor is not None and _image_executor_pid == os.getpid():
+        _image_executor.shutdown(wait=True)
+
+
+def init_worker(worker_class):
+    if worker_class == 'gevent':
+        # Make libpq waits yield to other greenlets
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    pool()
+    if app.config['METRICS_FOLDER']:
+        metrics.start_writing(app.config['METRICS_FOLDER'],
+                              app.config['METRICS_WRITE_INTERVAL'],
+                              process_gauges)
+
+
+def serve(bind, workers, threads, graceful_timeout, worker_class=None,
+          worker_connections=1000):
+    from gunicorn.app.base import BaseApplication
+
+    if worker_class is None:
+        worker_class = 'gthread' if threads > 1 else 'sync'
+    app.config['EVENT_STREAMS'] = worker_class == 'gevent'
+    # Workers share the listening socket, so a scrape reaches any one of
+    # them; each needs to see the others' metrics
+    temporary_metrics = not app.config['METRICS_FOLDER']
+    if temporary_metrics:
+        app.config['METRICS_FOLDER'] = tempfile.mkdtemp(
+            prefix='suxiv-metrics-'
+        )
+    for path in glob.glob(os.path.join(app.config['METRICS_FOLDER'],
+                                       '*.pickle')):
+        os.remove(path)
+
+    def remove_metrics():
+        if temporary_metrics:
+            shutil.rmtree(app.config['METRICS_FOLDER'], ignore_errors=True)
+
+    class Application(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': bind,
+                'workers': workers,
+                'threads': threads,
+                'worker_class': worker_class,
+                'worker_connections': worker_connections,
+                # Import once in the master; workers share its pages
+                'preload_app': True,
+                'graceful_timeout': graceful_timeout,
+                'post_worker_init':
+                    lambda worker: init_worker(worker_class),
+                'worker_exit': lambda server, worker: shutdown_worker(),
+                'on_exit': lambda server: remove_metrics(),
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Application().run()
+
 
 if __name__ == '__main__':
-    from wsgi_lineprof.middleware import LineProfilerMiddleware
-    from wsgi_lineprof.filters import FilenameFilter
-    from wsgiref.simple_server import make_server
-    profile_app = LineProfilerMiddleware(app, filters=[FilenameFilter("main.py")])
-    with make_server('0.0.0.0', 5000, profile_app) as server:
-        server.serve_forever()
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve Suxiv.')
+    parser.add_argument('--bind',
+                        default=os.environ.get('WEB_BIND', '0.0.0.0:5000'))
+    parser.add_argument('--workers', type=int,
+                        default=int(os.environ.get('WEB_WORKERS') or
+                                    os.cpu_count() or 1))
+    parser.add_argument('--threads', type=int,
+                        default=int(os.environ.get('WEB_THREADS', 4)))
+    parser.add_argument('--worker-class',
+                        default=os.environ.get('WEB_WORKER_CLASS') or None,
+                        help='sync, gthread or gevent (which also serves '
+                        'notification streams)')
+    parser.add_argument('--worker-connections', type=int,
+                        default=int(os.environ.get('WEB_WORKER_CONNECTIONS',
+                                                   1000)))
+    parser.add_argument('--graceful-timeout', type=int,
+                        default=int(os.environ.get('WEB_GRACEFUL_TIMEOUT',
+                                                   30)))
+    parser.add_argument('--profile', action='store_true',
+                        help='serve one request at a time under the '
+                        'line profiler')
+    args = parser.parse_args()
+
+    if args.profile:
+        from wsgi_lineprof.middleware import LineProfilerMiddleware
+        from wsgi_lineprof.filters import FilenameFilter
+        from wsgiref.simple_server import make_server
+        host, port = args.bind.rsplit(':', 1)
+        profile_app = LineProfilerMiddleware(
+            app, filters=[FilenameFilter("main.py")]
+        )
+        with make_server(host, int(port), profile_app) as server:
+            server.serve_forever()
+    else:
+        serve(args.bind, args.workers, args.threads, args.graceful_timeout,
+              args.worker_class, args.worker_connections)
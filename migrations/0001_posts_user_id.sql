@@ -0,0 +1,4 @@
+-- no-transaction
+-- Posts of a user, newest first (userpage, index feed)
+DROP INDEX CONCURRENTLY IF EXISTS posts_user_id_id;
+CREATE INDEX CONCURRENTLY posts_user_id_id ON posts USING btree (user_id, id DESC);
@@ -0,0 +1,4 @@
+-- no-transaction
+-- Followers of a user (follower lists, fan-out of uploads)
+DROP INDEX CONCURRENTLY IF EXISTS relations_following_id;
+CREATE INDEX CONCURRENTLY relations_following_id ON relations USING btree (following_id);
@@ -0,0 +1,4 @@
+-- no-transaction
+-- Favorites of a post (favorite counts and removal with the post)
+DROP INDEX CONCURRENTLY IF EXISTS favorites_post_id;
+CREATE INDEX CONCURRENTLY favorites_post_id ON favorites USING btree (post_id);
@@ -0,0 +1,5 @@
+-- no-transaction
+-- Comments of a post in order; supersedes comments_post_id
+DROP INDEX CONCURRENTLY IF EXISTS comments_post_id_created_at;
+CREATE INDEX CONCURRENTLY comments_post_id_created_at ON comments USING btree (post_id, created_at);
+DROP INDEX CONCURRENTLY IF EXISTS comments_post_id;
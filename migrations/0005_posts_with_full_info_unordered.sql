@@ -0,0 +1,13 @@
+-- The ORDER BY kept LIMIT queries on the view from walking posts_pkey
+-- backwards; every caller orders the rows itself.
+CREATE OR REPLACE VIEW posts_with_full_info AS
+ SELECT p.id,
+    p.user_id,
+    p.title,
+    p.description,
+    p.path,
+    u.username,
+    p.favorites_count,
+    p.updated_at
+   FROM (posts p
+     JOIN users u ON ((p.user_id = u.id)));
@@ -0,0 +1,16 @@
+-- Lets every process drop its cached copy of a changed profile
+CREATE FUNCTION notify_user() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM pg_notify('users', OLD.id || ':' || OLD.username);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        PERFORM pg_notify('users', NEW.id || ':' || NEW.username);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER users_notify AFTER INSERT OR DELETE OR UPDATE OF username, description ON users FOR EACH ROW EXECUTE PROCEDURE notify_user();
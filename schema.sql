@@ -21,9 +21,12 @@ ALTER TABLE ONLY public.relations DROP CONSTRAINT relations_follower_id_fkey;
 ALTER TABLE ONLY public.posts DROP CONSTRAINT posts_user_id_fkey;
 ALTER TABLE ONLY public.favorites DROP CONSTRAINT favorites_user_id_fkey;
 ALTER TABLE ONLY public.favorites DROP CONSTRAINT favorites_post_id_fkey;
-ALTER TABLE ONLY public.events DROP CONSTRAINT events_source_id_fkey;
-ALTER TABLE ONLY public.events DROP CONSTRAINT events_receiver_id_fkey;
-ALTER TABLE ONLY public.events DROP CONSTRAINT events_invoker_id_fkey;
+ALTER TABLE public.events DROP CONSTRAINT events_source_id_fkey;
+ALTER TABLE public.events DROP CONSTRAINT events_receiver_id_fkey;
+ALTER TABLE public.events DROP CONSTRAINT events_invoker_id_fkey;
+ALTER TABLE ONLY public.event_outbox DROP CONSTRAINT event_outbox_source_id_fkey;
+ALTER TABLE ONLY public.event_outbox DROP CONSTRAINT event_outbox_receiver_id_fkey;
+ALTER TABLE ONLY public.event_outbox DROP CONSTRAINT event_outbox_invoker_id_fkey;
 ALTER TABLE ONLY public.event_haveread DROP CONSTRAINT event_haveread_user_id_fkey;
 ALTER TABLE ONLY public.comments DROP CONSTRAINT comments_user_id_fkey;
 ALTER TABLE ONLY public.comments DROP CONSTRAINT comments_post_id_fkey;
@@ -35,26 +38,49 @@ SELECT
     NULL::text AS description,
     NULL::text AS path,
     NULL::character varying(32) AS username,
-    NULL::bigint AS favorites_count;
-DROP INDEX public.posts_title;
-DROP INDEX public.posts_description;
-DROP INDEX public.events_receiver_id;
+    NULL::integer AS favorites_count,
+    NULL::timestamp without time zone AS updated_at;
+ALTER TABLE ONLY public.timelines DROP CONSTRAINT timelines_user_id_fkey;
+ALTER TABLE ONLY public.timelines DROP CONSTRAINT timelines_post_id_fkey;
+ALTER TABLE ONLY public.timelines DROP CONSTRAINT timelines_author_id_fkey;
+DROP TRIGGER users_notify ON public.users;
+DROP TRIGGER relations_count ON public.relations;
+DROP TRIGGER posts_count ON public.posts;
+DROP TRIGGER favorites_count ON public.favorites;
+DROP TRIGGER events_notify ON public.events;
+DROP TRIGGER events_count ON public.events;
+DROP INDEX public.timelines_post_id;
+DROP INDEX public.relations_following_id;
+DROP INDEX public.posts_user_id_id;
+DROP INDEX public.posts_unpushed;
+DROP INDEX public.posts_favorite_ranking_rank;
+DROP INDEX public.posts_search;
+DROP INDEX public.events_source_id;
+DROP INDEX public.events_receiver_id_id;
+DROP INDEX public.favorites_post_id;
+DROP INDEX public.events_invoker_id;
 DROP INDEX public.created_at;
-DROP INDEX public.comments_post_id;
+DROP INDEX public.comments_post_id_created_at;
 ALTER TABLE ONLY public.users DROP CONSTRAINT users_username_key;
 ALTER TABLE ONLY public.users DROP CONSTRAINT users_pkey;
+ALTER TABLE ONLY public.timelines DROP CONSTRAINT timelines_pkey;
+ALTER TABLE ONLY public.schema_migrations DROP CONSTRAINT schema_migrations_pkey;
 ALTER TABLE ONLY public.relations DROP CONSTRAINT relations_pkey;
 ALTER TABLE ONLY public.posts DROP CONSTRAINT posts_pkey;
 ALTER TABLE ONLY public.favorites DROP CONSTRAINT favorites_pkey;
-ALTER TABLE ONLY public.events DROP CONSTRAINT events_pkey;
+ALTER TABLE public.events DROP CONSTRAINT events_pkey;
+ALTER TABLE ONLY public.event_outbox DROP CONSTRAINT event_outbox_pkey;
 ALTER TABLE ONLY public.event_haveread DROP CONSTRAINT event_haveread_pkey;
 ALTER TABLE ONLY public.comments DROP CONSTRAINT comments_pkey;
 ALTER TABLE public.users ALTER COLUMN id DROP DEFAULT;
 ALTER TABLE public.posts ALTER COLUMN id DROP DEFAULT;
 ALTER TABLE public.events ALTER COLUMN id DROP DEFAULT;
+ALTER TABLE public.event_outbox ALTER COLUMN id DROP DEFAULT;
 ALTER TABLE public.comments ALTER COLUMN id DROP DEFAULT;
 DROP SEQUENCE public.users_id_seq;
 DROP TABLE public.users;
+DROP TABLE public.timelines;
+DROP TABLE public.schema_migrations;
 DROP TABLE public.relations;
 DROP SEQUENCE public.posts_id_seq;
 DROP MATERIALIZED VIEW public.posts_favorite_ranking;
@@ -62,10 +88,19 @@ DROP VIEW public.posts_with_full_info;
 DROP TABLE public.posts;
 DROP TABLE public.favorites;
 DROP SEQUENCE public.events_id_seq;
+DROP TABLE public.events_default;
 DROP TABLE public.events;
+DROP SEQUENCE public.event_outbox_id_seq;
+DROP TABLE public.event_outbox;
 DROP TABLE public.event_haveread;
 DROP SEQUENCE public.comments_id_seq;
 DROP TABLE public.comments;
+DROP FUNCTION public.notify_user();
+DROP FUNCTION public.notify_event();
+DROP FUNCTION public.count_relations();
+DROP FUNCTION public.count_posts();
+DROP FUNCTION public.count_favorites();
+DROP FUNCTION public.count_events();
 DROP TYPE public.event_type;
 DROP EXTENSION pg_bigm;
 DROP EXTENSION plpgsql;
@@ -126,6 +161,129 @@ CREATE TYPE event_type AS ENUM (
 );
 
 
+--
+-- Name: count_events(); Type: FUNCTION; Schema: public; Owner: -
+--
+
+CREATE FUNCTION count_events() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE event_haveread SET unread_count = unread_count + 1
+        WHERE user_id = NEW.receiver_id AND since < NEW.created_at;
+        PERFORM pg_notify('unread_events', NEW.receiver_id::text);
+    ELSE
+        UPDATE event_haveread SET unread_count = unread_count - 1
+        WHERE user_id = OLD.receiver_id AND since < OLD.created_at;
+        PERFORM pg_notify('unread_events', OLD.receiver_id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+
+--
+-- Name: count_favorites(); Type: FUNCTION; Schema: public; Owner: -
+--
+
+CREATE FUNCTION count_favorites() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE posts SET favorites_count = favorites_count + 1
+        WHERE id = NEW.post_id;
+        UPDATE users SET favorites_count = favorites_count + 1
+        WHERE id = NEW.user_id;
+    ELSE
+        UPDATE posts SET favorites_count = favorites_count - 1
+        WHERE id = OLD.post_id;
+        UPDATE users SET favorites_count = favorites_count - 1
+        WHERE id = OLD.user_id;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+
+--
+-- Name: count_posts(); Type: FUNCTION; Schema: public; Owner: -
+--
+
+CREATE FUNCTION count_posts() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE users SET posts_count = posts_count + 1
+        WHERE id = NEW.user_id;
+    ELSE
+        UPDATE users SET posts_count = posts_count - 1
+        WHERE id = OLD.user_id;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+
+--
+-- Name: count_relations(); Type: FUNCTION; Schema: public; Owner: -
+--
+
+CREATE FUNCTION count_relations() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE users SET following_count = following_count + 1
+        WHERE id = NEW.follower_id;
+        UPDATE users SET follower_count = follower_count + 1
+        WHERE id = NEW.following_id;
+    ELSE
+        UPDATE users SET following_count = following_count - 1
+        WHERE id = OLD.follower_id;
+        UPDATE users SET follower_count = follower_count - 1
+        WHERE id = OLD.following_id;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+
+--
+-- Name: notify_event(); Type: FUNCTION; Schema: public; Owner: -
+--
+
+CREATE FUNCTION notify_event() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    PERFORM pg_notify('new_events', NEW.receiver_id || ':' || NEW.id);
+    RETURN NULL;
+END;
+$$;
+
+
+--
+-- Name: notify_user(); Type: FUNCTION; Schema: public; Owner: -
+--
+
+CREATE FUNCTION notify_user() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM pg_notify('users', OLD.id || ':' || OLD.username);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        PERFORM pg_notify('users', NEW.id || ':' || NEW.username);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+
 SET default_with_oids = false;
 
 --
@@ -168,10 +326,48 @@ ALTER SEQUENCE comments_id_seq OWNED BY comments.id;
 
 CREATE TABLE event_haveread (
     user_id integer NOT NULL,
-    since timestamp without time zone DEFAULT now()
+    since timestamp without time zone DEFAULT now(),
+    unread_count integer DEFAULT 0 NOT NULL
 );
 
 
+--
+-- Name: event_outbox; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE event_outbox (
+    id integer NOT NULL,
+    type event_type NOT NULL,
+    source_id integer,
+    invoker_id integer NOT NULL,
+    receiver_id integer,
+    attempts integer DEFAULT 0 NOT NULL,
+    last_error text,
+    available_at timestamp without time zone DEFAULT now() NOT NULL,
+    created_at timestamp without time zone DEFAULT now()
+);
+
+
+--
+-- Name: event_outbox_id_seq; Type: SEQUENCE; Schema: public; Owner: -
+--
+
+CREATE SEQUENCE event_outbox_id_seq
+    AS integer
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+--
+-- Name: event_outbox_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: -
+--
+
+ALTER SEQUENCE event_outbox_id_seq OWNED BY event_outbox.id;
+
+
 --
 -- Name: events; Type: TABLE; Schema: public; Owner: -
 --
@@ -179,11 +375,20 @@ CREATE TABLE event_haveread (
 CREATE TABLE events (
     id integer NOT NULL,
     receiver_id integer,
-    created_at timestamp without time zone DEFAULT now(),
+    created_at timestamp without time zone DEFAULT now() NOT NULL,
     type event_type NOT NULL,
     source_id integer,
-    invoker_id integer
-);
+    invoker_id integer,
+    actor_ids integer[] DEFAULT '{}'::integer[] NOT NULL
+)
+PARTITION BY RANGE (created_at);
+
+
+--
+-- Name: events_default; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE events_default PARTITION OF events DEFAULT;
 
 
 --
@@ -228,7 +433,9 @@ CREATE TABLE posts (
     description text NOT NULL,
     path text NOT NULL,
     created_at timestamp without time zone DEFAULT now(),
-    updated_at timestamp without time zone DEFAULT now()
+    updated_at timestamp without time zone DEFAULT now(),
+    favorites_count integer DEFAULT 0 NOT NULL,
+    timeline_pushed boolean DEFAULT false NOT NULL
 );
 
 
@@ -244,7 +451,8 @@ SELECT
     NULL::text AS description,
     NULL::text AS path,
     NULL::character varying(32) AS username,
-    NULL::bigint AS favorites_count;
+    NULL::integer AS favorites_count,
+    NULL::timestamp without time zone AS updated_at;
 
 
 --
@@ -252,13 +460,15 @@ SELECT
 --
 
 CREATE MATERIALIZED VIEW posts_favorite_ranking AS
- SELECT posts_with_full_info.id,
+ SELECT row_number() OVER (ORDER BY posts_with_full_info.favorites_count DESC, posts_with_full_info.id) AS rank,
+    posts_with_full_info.id,
     posts_with_full_info.user_id,
     posts_with_full_info.title,
     posts_with_full_info.description,
     posts_with_full_info.path,
     posts_with_full_info.username,
-    posts_with_full_info.favorites_count
+    posts_with_full_info.favorites_count,
+    posts_with_full_info.updated_at
    FROM posts_with_full_info
   ORDER BY posts_with_full_info.favorites_count DESC, posts_with_full_info.id
   WITH NO DATA;
@@ -296,6 +506,27 @@ CREATE TABLE relations (
 );
 
 
+--
+-- Name: schema_migrations; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE schema_migrations (
+    version character varying(255) NOT NULL,
+    applied_at timestamp without time zone DEFAULT now() NOT NULL
+);
+
+
+--
+-- Name: timelines; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE timelines (
+    user_id integer NOT NULL,
+    post_id integer NOT NULL,
+    author_id integer NOT NULL
+);
+
+
 --
 -- Name: users; Type: TABLE; Schema: public; Owner: -
 --
@@ -308,6 +539,10 @@ CREATE TABLE users (
     description text DEFAULT ''::text NOT NULL,
     created_at timestamp without time zone DEFAULT now(),
     updated_at timestamp without time zone DEFAULT now(),
+    posts_count integer DEFAULT 0 NOT NULL,
+    following_count integer DEFAULT 0 NOT NULL,
+    follower_count integer DEFAULT 0 NOT NULL,
+    favorites_count integer DEFAULT 0 NOT NULL,
     CONSTRAINT username_pattern CHECK (((username)::text ~ '[a-zA-Z_][0-9a-zA-Z_]{3,31}'::text))
 );
 
@@ -339,6 +574,13 @@ ALTER SEQUENCE users_id_seq OWNED BY users.id;
 ALTER TABLE ONLY comments ALTER COLUMN id SET DEFAULT nextval('comments_id_seq'::regclass);
 
 
+--
+-- Name: event_outbox id; Type: DEFAULT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY event_outbox ALTER COLUMN id SET DEFAULT nextval('event_outbox_id_seq'::regclass);
+
+
 --
 -- Name: events id; Type: DEFAULT; Schema: public; Owner: -
 --
@@ -360,6 +602,18 @@ ALTER TABLE ONLY posts ALTER COLUMN id SET DEFAULT nextval('posts_id_seq'::regcl
 ALTER TABLE ONLY users ALTER COLUMN id SET DEFAULT nextval('users_id_seq'::regclass);
 
 
+--
+-- Data for Name: schema_migrations; Type: TABLE DATA; Schema: public; Owner: -
+--
+
+INSERT INTO schema_migrations (version) VALUES ('0001_posts_user_id');
+INSERT INTO schema_migrations (version) VALUES ('0002_relations_following_id');
+INSERT INTO schema_migrations (version) VALUES ('0003_favorites_post_id');
+INSERT INTO schema_migrations (version) VALUES ('0004_comments_post_id_created_at');
+INSERT INTO schema_migrations (version) VALUES ('0005_posts_with_full_info_unordered');
+INSERT INTO schema_migrations (version) VALUES ('0006_users_notify');
+
+
 --
 -- Name: comments comments_pkey; Type: CONSTRAINT; Schema: public; Owner: -
 --
@@ -376,12 +630,20 @@ ALTER TABLE ONLY event_haveread
     ADD CONSTRAINT event_haveread_pkey PRIMARY KEY (user_id);
 
 
+--
+-- Name: event_outbox event_outbox_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY event_outbox
+    ADD CONSTRAINT event_outbox_pkey PRIMARY KEY (id);
+
+
 --
 -- Name: events events_pkey; Type: CONSTRAINT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY events
-    ADD CONSTRAINT events_pkey PRIMARY KEY (id);
+ALTER TABLE events
+    ADD CONSTRAINT events_pkey PRIMARY KEY (id, created_at);
 
 
 --
@@ -408,6 +670,22 @@ ALTER TABLE ONLY relations
     ADD CONSTRAINT relations_pkey PRIMARY KEY (follower_id, following_id);
 
 
+--
+-- Name: schema_migrations schema_migrations_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY schema_migrations
+    ADD CONSTRAINT schema_migrations_pkey PRIMARY KEY (version);
+
+
+--
+-- Name: timelines timelines_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY timelines
+    ADD CONSTRAINT timelines_pkey PRIMARY KEY (user_id, post_id);
+
+
 --
 -- Name: users users_pkey; Type: CONSTRAINT; Schema: public; Owner: -
 --
@@ -425,10 +703,10 @@ ALTER TABLE ONLY users
 
 
 --
--- Name: comments_post_id; Type: INDEX; Schema: public; Owner: -
+-- Name: comments_post_id_created_at; Type: INDEX; Schema: public; Owner: -
 --
 
-CREATE INDEX comments_post_id ON comments USING btree (post_id);
+CREATE INDEX comments_post_id_created_at ON comments USING btree (post_id, created_at);
 
 
 --
@@ -439,24 +717,73 @@ CREATE INDEX created_at ON favorites USING btree (created_at);
 
 
 --
--- Name: events_receiver_id; Type: INDEX; Schema: public; Owner: -
+-- Name: events_invoker_id; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX events_invoker_id ON events USING btree (invoker_id);
+
+
+--
+-- Name: events_receiver_id_id; Type: INDEX; Schema: public; Owner: -
 --
 
-CREATE INDEX events_receiver_id ON events USING btree (receiver_id);
+CREATE INDEX events_receiver_id_id ON events USING btree (receiver_id, id DESC);
 
 
 --
--- Name: posts_description; Type: INDEX; Schema: public; Owner: -
+-- Name: events_source_id; Type: INDEX; Schema: public; Owner: -
 --
 
-CREATE INDEX posts_description ON posts USING gin (description gin_bigm_ops);
+CREATE INDEX events_source_id ON events USING btree (source_id);
 
 
 --
--- Name: posts_title; Type: INDEX; Schema: public; Owner: -
+-- Name: favorites_post_id; Type: INDEX; Schema: public; Owner: -
 --
 
-CREATE INDEX posts_title ON posts USING gin (title gin_bigm_ops);
+CREATE INDEX favorites_post_id ON favorites USING btree (post_id);
+
+
+--
+-- Name: posts_favorite_ranking_rank; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE UNIQUE INDEX posts_favorite_ranking_rank ON posts_favorite_ranking USING btree (rank);
+
+
+--
+-- Name: posts_search; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX posts_search ON posts USING gin ((((title || ' '::text) || description)) gin_bigm_ops);
+
+
+--
+-- Name: posts_unpushed; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX posts_unpushed ON posts USING btree (user_id, id DESC) WHERE (NOT timeline_pushed);
+
+
+--
+-- Name: posts_user_id_id; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX posts_user_id_id ON posts USING btree (user_id, id DESC);
+
+
+--
+-- Name: relations_following_id; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX relations_following_id ON relations USING btree (following_id);
+
+
+--
+-- Name: timelines_post_id; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX timelines_post_id ON timelines USING btree (post_id);
 
 
 --
@@ -470,12 +797,52 @@ CREATE OR REPLACE VIEW posts_with_full_info AS
     p.description,
     p.path,
     u.username,
-    count(f.user_id) AS favorites_count
-   FROM ((posts p
-     JOIN users u ON ((p.user_id = u.id)))
-     LEFT JOIN favorites f ON ((p.id = f.post_id)))
-  GROUP BY p.id, u.username
-  ORDER BY p.id DESC;
+    p.favorites_count,
+    p.updated_at
+   FROM (posts p
+     JOIN users u ON ((p.user_id = u.id)));
+
+
+--
+-- Name: events events_count; Type: TRIGGER; Schema: public; Owner: -
+--
+
+CREATE TRIGGER events_count AFTER INSERT OR DELETE ON events FOR EACH ROW EXECUTE PROCEDURE count_events();
+
+
+--
+-- Name: events events_notify; Type: TRIGGER; Schema: public; Owner: -
+--
+
+CREATE TRIGGER events_notify AFTER INSERT ON events FOR EACH ROW EXECUTE PROCEDURE notify_event();
+
+
+--
+-- Name: favorites favorites_count; Type: TRIGGER; Schema: public; Owner: -
+--
+
+CREATE TRIGGER favorites_count AFTER INSERT OR DELETE ON favorites FOR EACH ROW EXECUTE PROCEDURE count_favorites();
+
+
+--
+-- Name: posts posts_count; Type: TRIGGER; Schema: public; Owner: -
+--
+
+CREATE TRIGGER posts_count AFTER INSERT OR DELETE ON posts FOR EACH ROW EXECUTE PROCEDURE count_posts();
+
+
+--
+-- Name: relations relations_count; Type: TRIGGER; Schema: public; Owner: -
+--
+
+CREATE TRIGGER relations_count AFTER INSERT OR DELETE ON relations FOR EACH ROW EXECUTE PROCEDURE count_relations();
+
+
+--
+-- Name: users users_notify; Type: TRIGGER; Schema: public; Owner: -
+--
+
+CREATE TRIGGER users_notify AFTER INSERT OR DELETE OR UPDATE OF username, description ON users FOR EACH ROW EXECUTE PROCEDURE notify_user();
 
 
 --
@@ -502,11 +869,35 @@ ALTER TABLE ONLY event_haveread
     ADD CONSTRAINT event_haveread_user_id_fkey FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE;
 
 
+--
+-- Name: event_outbox event_outbox_invoker_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY event_outbox
+    ADD CONSTRAINT event_outbox_invoker_id_fkey FOREIGN KEY (invoker_id) REFERENCES users(id) ON DELETE CASCADE;
+
+
+--
+-- Name: event_outbox event_outbox_receiver_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY event_outbox
+    ADD CONSTRAINT event_outbox_receiver_id_fkey FOREIGN KEY (receiver_id) REFERENCES users(id) ON DELETE CASCADE;
+
+
+--
+-- Name: event_outbox event_outbox_source_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY event_outbox
+    ADD CONSTRAINT event_outbox_source_id_fkey FOREIGN KEY (source_id) REFERENCES posts(id) ON DELETE CASCADE;
+
+
 --
 -- Name: events events_invoker_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY events
+ALTER TABLE events
     ADD CONSTRAINT events_invoker_id_fkey FOREIGN KEY (invoker_id) REFERENCES users(id) ON DELETE CASCADE;
 
 
@@ -514,7 +905,7 @@ ALTER TABLE ONLY events
 -- Name: events events_receiver_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY events
+ALTER TABLE events
     ADD CONSTRAINT events_receiver_id_fkey FOREIGN KEY (receiver_id) REFERENCES users(id) ON DELETE CASCADE;
 
 
@@ -522,7 +913,7 @@ ALTER TABLE ONLY events
 -- Name: events events_source_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY events
+ALTER TABLE events
     ADD CONSTRAINT events_source_id_fkey FOREIGN KEY (source_id) REFERENCES posts(id) ON DELETE CASCADE;
 
 
@@ -566,6 +957,30 @@ ALTER TABLE ONLY relations
     ADD CONSTRAINT relations_following_id_fkey FOREIGN KEY (following_id) REFERENCES users(id) ON DELETE CASCADE;
 
 
+--
+-- Name: timelines timelines_author_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY timelines
+    ADD CONSTRAINT timelines_author_id_fkey FOREIGN KEY (author_id) REFERENCES users(id) ON DELETE CASCADE;
+
+
+--
+-- Name: timelines timelines_post_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY timelines
+    ADD CONSTRAINT timelines_post_id_fkey FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE;
+
+
+--
+-- Name: timelines timelines_user_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY timelines
+    ADD CONSTRAINT timelines_user_id_fkey FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE;
+
+
 --
 -- Name: public; Type: ACL; Schema: -; Owner: -
 --
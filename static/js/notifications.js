@@ -0,0 +1,28 @@
+$(function () {
+  var link = $('#notifications');
+  if (!link.data('stream') || !window.EventSource) {
+    return;
+  }
+  var source = new EventSource(link.data('stream'));
+
+  source.addEventListener('unread', function (e) {
+    var count = parseInt(e.data, 10);
+    var badge = link.find('.badge');
+    if (count > 0) {
+      if (!badge.length) {
+        badge = $('<span class="badge"></span>').appendTo(link);
+      }
+      badge.text(count);
+    } else {
+      badge.remove();
+    }
+  });
+
+  source.addEventListener('event', function (e) {
+    var item = $(e.data);
+    var events = $('#events');
+    // A repeated action replaces the newest event of the same kind
+    events.find('[data-source="' + item.data('source') + '"]').first().remove();
+    events.prepend(item);
+  });
+});
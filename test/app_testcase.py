@@ -7,6 +7,7 @@ class AppTestCase(unittest.TestCase):
     def setUp(self):
         main.app.testing = True
         main.app.config['UPLOAD_FOLDER'] = os.environ['TEST_UPLOAD_FOLDER']
+        main.app.config['IMAGE_WORKERS'] = 0
         self.client = main.app.test_client()
         self.initialize()
 
@@ -66,3 +67,14 @@ class AppTestCase(unittest.TestCase):
         return self.client.post(
             f'/post/{post_id}/delete', follow_redirects=True
         )
+
+    def listen_for_notifications(self):
+        main.notifications.ensure_started()
+        self.assertTrue(main.notifications.connected.wait(5))
+
+    def drain_outbox(self):
+        conn = main.connect_db()
+        try:
+            return main.drain_outbox(conn, 100)
+        finally:
+            conn.close()
@@ -1,3 +1,7 @@
+import re
+import select
+import time
+import main
 from test.app_testcase import AppTestCase
 
 
@@ -10,3 +14,288 @@ class EventTest(AppTestCase):
         self.register('alice', 'alicealice')
         res = self.client.get('/events')
         self.assertEqual(200, res.status_code)
+
+    def test_events_are_delivered_through_outbox(self):
+        self.register('alice', 'alicealice')
+        self.logout()
+        self.register('bobby', 'bobbobbob')
+        self.follow('alice')
+        self.logout()
+
+        self.login('alice', 'alicealice')
+        res = self.client.get('/events')
+        self.assertNotIn(b'followed you', res.data)
+
+        self.assertEqual(1, self.drain_outbox())
+        self.assertEqual(0, self.drain_outbox())
+        res = self.client.get('/events')
+        self.assertIn(b'followed you', res.data)
+
+    def test_post_event_is_fanned_out_to_followers(self):
+        self.register('alice', 'alicealice')
+        self.logout()
+        self.register('bobby', 'bobbobbob')
+        self.follow('alice')
+        self.logout()
+
+        self.login('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'hoge', 'fuga')
+        self.drain_outbox()
+        self.logout()
+
+        self.login('bobby', 'bobbobbob')
+        res = self.client.get('/events')
+        self.assertIn(b'posted', res.data)
+        self.assertIn(b'hoge', res.data)
+
+    def test_undone_favorite_is_not_delivered(self):
+        self.register('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'hoge', 'fuga')
+        self.drain_outbox()
+        self.logout()
+
+        self.register('bobby', 'bobbobbob')
+        self.favorite(1)
+        self.unfavorite(1)
+        self.assertEqual(0, self.drain_outbox())
+        self.logout()
+
+        self.login('alice', 'alicealice')
+        res = self.client.get('/events')
+        self.assertNotIn(b'favorited', res.data)
+
+    def notification_count(self):
+        res = self.client.get('/mypage', follow_redirects=True)
+        match = re.search(rb'notifications\s*<span class="badge">(\d+)',
+                          res.data)
+        return int(match.group(1)) if match else 0
+
+    def wait_for_notification_count(self, expected):
+        deadline = time.monotonic() + 5
+        while self.notification_count() != expected:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+    def test_unread_count_is_cached_and_invalidated(self):
+        self.listen_for_notifications()
+        self.register('alice', 'alicealice')
+        self.logout()
+        self.register('bobby', 'bobbobbob')
+        self.follow('alice')
+        self.logout()
+
+        self.login('alice', 'alicealice')
+        self.assertEqual(0, self.notification_count())
+        hits = main.unread_cache.hits
+        self.assertEqual(0, self.notification_count())
+        self.assertEqual(hits + 1, main.unread_cache.hits)
+
+        # Delivered by another connection, so only NOTIFY invalidates it
+        self.drain_outbox()
+        self.wait_for_notification_count(1)
+
+        self.client.get('/events')
+        self.assertEqual(0, self.notification_count())
+
+    def test_only_logged_in_user_can_stream_events(self):
+        res = self.client.get('/events/stream')
+        self.assertNotEqual(200, res.status_code)
+
+    def test_events_are_only_streamed_on_gevent_workers(self):
+        self.register('alice', 'alicealice')
+        res = self.client.get('/events')
+        self.assertNotIn(b'data-stream', res.data)
+        self.assertNotIn(b'notifications.js', res.data)
+        self.assertEqual(404, self.client.get('/events/stream').status_code)
+
+        self.addCleanup(main.app.config.__setitem__, 'EVENT_STREAMS', False)
+        main.app.config['EVENT_STREAMS'] = True
+        res = self.client.get('/events')
+        self.assertIn(b'data-stream="/events/stream"', res.data)
+        self.assertIn(b'notifications.js', res.data)
+
+    def test_events_are_streamed(self):
+        self.addCleanup(main.app.config.__setitem__, 'EVENT_STREAMS', False)
+        main.app.config['EVENT_STREAMS'] = True
+        self.listen_for_notifications()
+        self.register('alice', 'alicealice')
+        self.logout()
+        self.register('bobby', 'bobbobbob')
+        self.follow('alice')
+        self.logout()
+
+        self.login('alice', 'alicealice')
+        res = self.client.get('/events/stream')
+        self.assertEqual('text/event-stream', res.mimetype)
+        stream = iter(res.response)
+        self.assertEqual(b'event: unread\ndata: 0\n\n', next(stream))
+        self.assertEqual(1, len(main.event_streams))
+
+        self.drain_outbox()
+        messages = [next(stream), next(stream)]
+        self.assertIn(b'event: unread\ndata: 1\n\n', messages)
+        self.assertIn(b'followed you', b''.join(messages))
+
+        res.close()
+        self.assertEqual(0, len(main.event_streams))
+
+    def test_reconcile_unread_counts(self):
+        self.register('alice', 'alicealice')
+        self.logout()
+        self.register('bobby', 'bobbobbob')
+        self.follow('alice')
+        self.drain_outbox()
+        with main.connect_db() as conn:
+            conn.cursor().execute('''
+            UPDATE event_haveread SET unread_count = 5
+            ''')
+        res = main.app.test_cli_runner().invoke(
+            main.reconcile_counters_command
+        )
+        self.assertIn('2 unread counts', res.output)
+
+    def events_maintenance(self, *args):
+        return main.app.test_cli_runner().invoke(
+            main.events_maintenance_command, args
+        )
+
+    def test_events_maintenance_moves_events_into_partitions(self):
+        self.register('alice', 'alicealice')
+        self.logout()
+        self.register('bobby', 'bobbobbob')
+        self.follow('alice')
+        self.drain_outbox()
+        self.logout()
+
+        self.events_maintenance()
+        conn = main.connect_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) FROM ONLY events_default')
+            self.assertEqual(0, cursor.fetchone()[0])
+            cursor.execute('SELECT COUNT(*) FROM events')
+            self.assertEqual(1, cursor.fetchone()[0])
+        finally:
+            conn.close()
+
+        self.login('alice', 'alicealice')
+        self.assertEqual(1, self.notification_count())
+        res = self.client.get('/events')
+        self.assertIn(b'followed you', res.data)
+
+    def test_moving_events_into_partition_fires_no_triggers(self):
+        self.register('alice', 'alicealice')
+        self.logout()
+        self.register('bobby', 'bobbobbob')
+        self.follow('alice')
+        self.drain_outbox()
+        self.logout()
+        with main.connect_db() as conn:
+            conn.cursor().execute('''
+            UPDATE events SET created_at = '2100-01-15'
+            ''')
+
+        listener = main.connect_db()
+        try:
+            listener.autocommit = True
+            cursor = listener.cursor()
+            cursor.execute('LISTEN new_events')
+            cursor.execute('LISTEN unread_events')
+            with main.connect_db() as conn:
+                main.create_events_partition(conn.cursor(),
+                                             main.date(2100, 1, 1))
+            select.select([listener], [], [], 0.5)
+            listener.poll()
+            self.assertEqual([], listener.notifies)
+            cursor.execute('SELECT COUNT(*) FROM ONLY events_default')
+            self.assertEqual(0, cursor.fetchone()[0])
+            cursor.execute('SELECT COUNT(*) FROM events_p210001')
+            self.assertEqual(1, cursor.fetchone()[0])
+            cursor.execute('SELECT unread_count FROM event_haveread')
+            self.assertEqual([[1], [0]], sorted(cursor.fetchall(),
+                                                reverse=True))
+        finally:
+            cursor.execute('DROP TABLE IF EXISTS events_p210001')
+            listener.close()
+
+    def test_events_maintenance_expires_old_partitions(self):
+        self.register('alice', 'alicealice')
+        self.logout()
+        self.register('bobby', 'bobbobbob')
+        self.follow('alice')
+        self.drain_outbox()
+        with main.connect_db() as conn:
+            cursor = conn.cursor()
+            main.create_events_partition(cursor, main.date(2000, 1, 1))
+            cursor.execute('''
+            UPDATE events SET created_at = '2000-01-15'
+            ''')
+            cursor.execute('''
+            UPDATE event_haveread SET since = '1999-12-31'
+            ''')
+
+        res = self.events_maintenance('--archive')
+        self.assertIn('Archived events_p200001', res.output)
+        with main.connect_db() as conn:
+            main.create_events_partition(conn.cursor(), main.date(2000, 2, 1))
+        res = self.events_maintenance()
+        self.assertIn('Dropped events_p200002', res.output)
+        with main.connect_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) FROM events')
+            self.assertEqual(0, cursor.fetchone()[0])
+            cursor.execute('SELECT COUNT(*) FROM events_p200001')
+            self.assertEqual(1, cursor.fetchone()[0])
+            cursor.execute('SELECT to_regclass(%s)', ('events_p200002',))
+            self.assertIsNone(cursor.fetchone()[0])
+            cursor.execute('SELECT SUM(unread_count) FROM event_haveread')
+            self.assertEqual(0, cursor.fetchone()[0])
+            cursor.execute('DROP TABLE events_p200001')
+
+    def count_events(self):
+        conn = main.connect_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) FROM events')
+            return cursor.fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_repeated_favorites_are_coalesced(self):
+        self.register('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'hoge', 'fuga')
+        self.logout()
+        for username in ('bobby', 'carol', 'david'):
+            self.register(username, 'password')
+            self.favorite(1)
+            self.logout()
+            self.drain_outbox()
+        self.assertEqual(1, self.count_events())
+
+        self.login('alice', 'alicealice')
+        self.assertEqual(1, self.notification_count())
+        res = self.client.get('/events')
+        self.assertRegex(res.data, rb'@david</a>\s*and 2 others\s*favorited')
+        self.logout()
+
+        self.login('david', 'password')
+        self.unfavorite(1)
+        self.logout()
+        self.login('alice', 'alicealice')
+        res = self.client.get('/events')
+        self.assertRegex(res.data, rb'@carol</a>\s*and 1 other\s*favorited')
+
+    def test_withdrawn_follow_removes_coalesced_event(self):
+        self.register('alice', 'alicealice')
+        self.logout()
+        self.register('bobby', 'bobbobbob')
+        self.follow('alice')
+        self.drain_outbox()
+        self.unfollow('alice')
+        self.assertEqual(0, self.count_events())
+
+        self.login('alice', 'alicealice')
+        self.assertEqual(0, self.notification_count())
@@ -1,3 +1,4 @@
+import main
 from test.app_testcase import AppTestCase
 
 
@@ -38,3 +39,63 @@ class FavoriteTest(AppTestCase):
         for i in range(10):
             self.assertIn(b'hoge%d' % i, res.data)
             self.assertIn(b'fuga%d' % i, res.data)
+
+    def test_favorites_count(self):
+        self.register('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'hoge', 'fuga')
+        self.logout()
+
+        self.register('bobby', 'bobbobbob')
+        self.favorite(1)
+        res = self.client.get('/posts')
+        self.assertIn(b'by 1 users', res.data)
+
+        self.unfavorite(1)
+        res = self.client.get('/posts')
+        self.assertNotIn(b'by 1 users', res.data)
+
+    def test_reconcile_counters(self):
+        self.register('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'hoge', 'fuga')
+        self.logout()
+
+        self.register('bobby', 'bobbobbob')
+        self.favorite(1)
+        with main.connect_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE posts SET favorites_count = 0')
+            cursor.execute('UPDATE users SET favorites_count = 0')
+
+        res = main.app.test_cli_runner().invoke(
+            main.reconcile_counters_command
+        )
+        self.assertIn('1 posts, 1 users', res.output)
+        res = self.client.get('/posts')
+        self.assertIn(b'by 1 users', res.data)
+
+    def test_ranking(self):
+        self.register('alice', 'alicealice')
+        for i in range(2):
+            with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+                self.upload(f, f'hoge{i}', f'fuga{i}')
+        self.logout()
+
+        self.register('bobby', 'bobbobbob')
+        self.favorite(2)
+        res = self.client.get('/posts/ranking')
+        self.assertEqual(200, res.status_code)
+        self.assertLess(res.data.index(b'hoge1'), res.data.index(b'hoge0'))
+
+        # The in-process top posts are swapped on refresh
+        self.unfavorite(2)
+        self.favorite(1)
+        main.ranking.refresh()
+        res = self.client.get('/posts/ranking')
+        self.assertLess(res.data.index(b'hoge0'), res.data.index(b'hoge1'))
+
+    def test_ranking_page_out_of_range_should_be_400(self):
+        for query in ('before=-5', 'after=-1', 'after=0'):
+            res = self.client.get(f'/posts/ranking?{query}')
+            self.assertEqual(400, res.status_code, query)
@@ -1,6 +1,160 @@
+import os
+import pickle
+import shutil
+import subprocess
+import tempfile
+from flask import g
+import main
 from test.app_testcase import AppTestCase
 
 
 class GeneralTest(AppTestCase):
     def test_can_see_index(self):
         self.client.get('/')
+
+    def test_connection_returns_to_pool(self):
+        self.register('alice', 'alicealice')
+        for _ in range(5):
+            self.client.get('/')
+        stats = main.pool().stats()
+        self.assertEqual(0, stats['in_use'])
+        self.assertEqual(stats['size'], stats['idle'])
+        self.assertLessEqual(stats['size'], main.app.config['POOL_MAX_SIZE'])
+
+    def test_anonymous_pages_are_cached(self):
+        self.listen_for_notifications()
+        self.register('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'hoge', 'fuga')
+        self.logout()
+
+        self.client.get('/@alice')
+        hits = main.page_cache.hits
+        res = self.client.get('/@alice', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(hits + 1, main.page_cache.hits)
+        self.assertEqual('gzip', res.headers['Content-Encoding'])
+        res = self.client.get('/@alice')
+        self.assertIn(b'hoge', res.data)
+
+        self.login('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'piyo', 'fuga')
+        self.assertEqual(hits + 2, main.page_cache.hits)
+        self.logout()
+        res = self.client.get('/@alice')
+        self.assertIn(b'piyo', res.data)
+
+    def test_metrics(self):
+        self.client.get('/posts')
+        res = self.client.get('/metrics')
+        self.assertEqual(200, res.status_code)
+        self.assertIn(b'# TYPE suxiv_request_duration_seconds histogram',
+                      res.data)
+        self.assertRegex(
+            res.data, rb'suxiv_request_duration_seconds_count\{'
+            rb'endpoint="list_posts",method="GET",status="200"\} \d+'
+        )
+        self.assertIn(b'suxiv_template_render_seconds_count'
+                      b'{template="posts.html"}', res.data)
+        self.assertIn(b'suxiv_pool_connections{state="idle"}', res.data)
+        self.assertIn(b'# TYPE suxiv_cache_hits_total counter', res.data)
+
+    def test_metrics_add_up_worker_processes(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.addCleanup(main.app.config.__setitem__, 'METRICS_FOLDER', None)
+        main.app.config['METRICS_FOLDER'] = folder
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+
+        other = main.Metrics()
+        other.describe('suxiv_cache_hits_total', 'counter', '')
+        labels = [('endpoint', 'elsewhere')]
+        other.inc('suxiv_slow_queries_total', labels, 2)
+        other.observe('suxiv_request_sql_seconds', labels, 0.5)
+        gauges = [
+            ('suxiv_event_streams', [], 3),
+            ('suxiv_cache_hits_total', [('cache', 'elsewhere')], 5),
+        ]
+        for pid in (os.getppid(), exited.pid):
+            with open(os.path.join(folder, f'{pid}.pickle'), 'wb') as f:
+                pickle.dump(other.snapshot(gauges), f)
+
+        res = self.client.get('/metrics')
+        self.assertIn(b'suxiv_slow_queries_total{endpoint="elsewhere"} 4\n',
+                      res.data)
+        self.assertIn(b'suxiv_request_sql_seconds_count'
+                      b'{endpoint="elsewhere"} 2\n', res.data)
+        # Only the live process still has open streams
+        self.assertIn(b'suxiv_event_streams 3\n', res.data)
+        self.assertIn(b'suxiv_cache_hits_total{cache="elsewhere"} 10\n',
+                      res.data)
+        self.assertTrue(os.path.exists(
+            os.path.join(folder, f'{os.getpid()}.pickle')
+        ))
+
+    def test_slow_queries_are_logged(self):
+        slow_query_ms = main.app.config['SLOW_QUERY_MS']
+        main.app.config['SLOW_QUERY_MS'] = 0.000001
+        try:
+            with self.assertLogs(main.app.logger, 'WARNING') as logs:
+                self.client.get('/posts')
+        finally:
+            main.app.config['SLOW_QUERY_MS'] = slow_query_ms
+        self.assertRegex(logs.output[0], r'in list_posts: SELECT \* FROM')
+
+    def test_get_requests_are_read_only(self):
+        self.register('alice', 'alicealice')
+        with self.client:
+            self.client.get('/posts')
+            self.assertTrue(g.db.readonly)
+        with self.client:
+            self.client.post('/setting', data={'description': 'hoge'})
+            self.assertFalse(g.db.readonly)
+        # Marks the events as read
+        with self.client:
+            self.client.get('/events')
+            self.assertFalse(g.db.readonly)
+
+    def test_request_runs_in_one_transaction(self):
+        with main.app.test_request_context('/', method='POST'):
+            with main.db() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT txid_current()')
+                txid = cursor.fetchone()[0]
+                cursor.execute('''
+                INSERT INTO users (username, salt, password)
+                VALUES ('alice', 'salt', 'password')
+                ''')
+            with main.db() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT txid_current()')
+                self.assertEqual(txid, cursor.fetchone()[0])
+            with self.assertRaises(ZeroDivisionError):
+                with main.db() as conn:
+                    1 / 0
+
+        conn = main.connect_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) FROM users')
+            self.assertEqual(0, cursor.fetchone()[0])
+        finally:
+            conn.close()
+
+    def test_error_response_rolls_back(self):
+        with main.app.test_request_context('/', method='POST'):
+            with main.db() as conn:
+                conn.cursor().execute('''
+                INSERT INTO users (username, salt, password)
+                VALUES ('alice', 'salt', 'password')
+                ''')
+            main.commit_db(main.app.response_class(status=500))
+
+        conn = main.connect_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) FROM users')
+            self.assertEqual(0, cursor.fetchone()[0])
+        finally:
+            conn.close()
@@ -0,0 +1,62 @@
+import main
+from test.app_testcase import AppTestCase
+
+
+class MigrationTest(AppTestCase):
+    def migrate(self):
+        res = main.app.test_cli_runner().invoke(main.migrate_command)
+        self.assertIsNone(res.exception)
+        return res.output
+
+    def execute(self, query, vars=None):
+        conn = main.connect_db()
+        try:
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute(query, vars)
+                return cursor.fetchall() if cursor.description else None
+        finally:
+            conn.close()
+
+    def valid_indexes(self, table):
+        return {row['relname'] for row in self.execute('''
+        SELECT c.relname
+        FROM pg_index i
+        INNER JOIN pg_class c
+        ON c.oid = i.indexrelid
+        WHERE i.indrelid = %s::regclass AND i.indisvalid
+        ''', (table,))}
+
+    def test_schema_has_all_migrations(self):
+        self.assertEqual('Applied 0 migrations\n', self.migrate())
+
+    def test_pending_migration_is_applied(self):
+        self.execute('''
+        DELETE FROM schema_migrations
+        WHERE version = '0004_comments_post_id_created_at';
+        DROP INDEX comments_post_id_created_at;
+        CREATE INDEX comments_post_id ON comments USING btree (post_id);
+        ''')
+
+        output = self.migrate()
+        self.assertIn('Applying 0004_comments_post_id_created_at', output)
+        self.assertIn('Applied 1 migrations', output)
+        indexes = self.valid_indexes('comments')
+        self.assertIn('comments_post_id_created_at', indexes)
+        self.assertNotIn('comments_post_id', indexes)
+        self.assertEqual('Applied 0 migrations\n', self.migrate())
+
+    def test_leftover_index_is_rebuilt(self):
+        self.execute('''
+        DELETE FROM schema_migrations
+        WHERE version = '0001_posts_user_id';
+        DROP INDEX posts_user_id_id;
+        CREATE INDEX posts_user_id_id ON posts USING btree (id);
+        ''')
+
+        self.migrate()
+        self.assertEqual(1, len(self.execute('''
+        SELECT 1 FROM pg_indexes
+        WHERE indexname = 'posts_user_id_id'
+        AND indexdef LIKE '%%(user_id, id DESC)'
+        ''')))
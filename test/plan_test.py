@@ -0,0 +1,201 @@
+import os
+import random
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from faker import Faker
+from flask import has_request_context, request
+import main
+from benchmarks import load
+from test.app_testcase import AppTestCase
+
+SCALE = float(os.environ.get('PLAN_TEST') or 0)
+MAX_COST = float(os.environ.get('PLAN_TEST_MAX_COST', 10000))
+SEQ_SCAN_ROWS = int(os.environ.get('PLAN_TEST_SEQ_SCAN_ROWS', 1000))
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+@unittest.skipUnless(SCALE, 'set PLAN_TEST=1 to check query plans')
+class PlanTest(AppTestCase):
+    @classmethod
+    def setUpClass(cls):
+        main.app.testing = True
+        main.app.config['UPLOAD_FOLDER'] = os.environ['TEST_UPLOAD_FOLDER']
+        main.app.config['IMAGE_WORKERS'] = 0
+        main.app.config['EVENT_STREAMS'] = True
+        fake = Faker()
+        fake.seed_instance(0)
+        cls.images = load.seed(SimpleNamespace(
+            users=int(1000 * SCALE), follows=10, posts=int(2000 * SCALE),
+            images=5, favorites=5, comments=int(5000 * SCALE), skew=1.0,
+        ), random.Random(0), fake)
+
+        conn = main.connect_db()
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute('ANALYZE')
+            cursor.execute('''
+            SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'
+            ''')
+            cls.table_rows = {
+                row['relname']: row['reltuples'] for row in cursor
+            }
+            # The most followed user, who also has the most posts
+            cursor.execute('''
+            SELECT u.username, u.id,
+            (SELECT MAX(id) FROM posts WHERE user_id = u.id) AS post_id
+            FROM users u ORDER BY follower_count DESC LIMIT 1
+            ''')
+            cls.popular = cursor.fetchone()
+            cursor.execute('''
+            SELECT username FROM users
+            WHERE id <> %(id)s AND id NOT IN (
+                SELECT following_id FROM relations WHERE follower_id = %(id)s
+            )
+            ORDER BY follower_count DESC LIMIT 1
+            ''', cls.popular)
+            cls.other = cursor.fetchone()
+            cursor.execute('''
+            SELECT id FROM posts ORDER BY favorites_count DESC LIMIT 1
+            ''')
+            cls.popular_post_id = cursor.fetchone()['id']
+            cursor.execute('SELECT title FROM posts LIMIT 1')
+            cls.word = cursor.fetchone()['title'].split()[0]
+        finally:
+            conn.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        main.app.config['EVENT_STREAMS'] = False
+
+    def initialize(self):
+        # Seeded once for the whole class
+        pass
+
+    def routes(self):
+        popular, other = self.popular['username'], self.other['username']
+        post_id = self.popular_post_id
+
+        # (logged in, method, path, form)
+        return [
+            (False, 'GET', '/', None),
+            (True, 'GET', '/', None),
+            (False, 'GET', '/posts', None),
+            (False, 'GET', '/posts/ranking', None),
+            (False, 'GET', f'/posts/search?query={self.word}', None),
+            (False, 'GET', f'/@{popular}', None),
+            (False, 'GET', f'/@{popular}/favorites', None),
+            (False, 'GET', f'/@{popular}/follower', None),
+            (False, 'GET', f'/@{popular}/following', None),
+            (False, 'GET', f'/post/{post_id}', None),
+            (False, 'GET', '/uploads/' + self.images[0], None),
+            (False, 'GET', '/metrics', None),
+            (False, 'GET', '/login', None),
+            (False, 'POST', '/login', {
+                'username': popular, 'password': load.PASSWORD,
+            }),
+            (False, 'GET', '/register', None),
+            (False, 'POST', '/register', {
+                'username': 'planner', 'password': 'plannerplanner',
+                'description': '',
+            }),
+            (True, 'GET', '/mypage', None),
+            (True, 'GET', '/events', None),
+            (True, 'GET', '/events/stream', None),
+            (True, 'GET', '/favorites', None),
+            (True, 'GET', '/follower', None),
+            (True, 'GET', '/following', None),
+            (True, 'GET', '/setting', None),
+            (True, 'POST', '/setting', {'description': 'plan'}),
+            (True, 'GET', '/upload', None),
+            (True, 'POST', '/upload', load.upload_form('plan', 'plan')),
+            (True, 'POST', f'/favorite/{post_id}', None),
+            (True, 'POST', f'/unfavorite/{post_id}', None),
+            (True, 'POST', '/follow', {'username': other}),
+            (True, 'POST', '/unfollow', {'username': other}),
+            (True, 'POST', f'/post/{post_id}/comment', {'content': 'plan'}),
+            (True, 'POST', f'/post/{self.popular["post_id"]}/delete', None),
+            (True, 'GET', '/logout', None),
+        ]
+
+    def capture(self, routes):
+        statements = []
+        execute = main.CountingCursor.execute
+
+        def recording_execute(cursor, query, vars=None):
+            if has_request_context():
+                statements.append((
+                    request.endpoint, cursor.mogrify(query, vars).decode()
+                ))
+            return execute(cursor, query, vars)
+
+        anonymous = main.app.test_client()
+        logged_in = main.app.test_client()
+        logged_in.post('/login', data={
+            'username': self.popular['username'], 'password': load.PASSWORD,
+        })
+        with mock.patch.object(main.CountingCursor, 'execute',
+                               recording_execute):
+            for is_logged_in, method, path, data in routes:
+                # Measure what a cold request issues
+                for cache in (main.page_cache, main.post_cards,
+                              main.search_cache, main.unread_cache):
+                    cache.clear()
+                client = logged_in if is_logged_in else anonymous
+                res = client.open(path, method=method, data=data)
+                self.assertLess(res.status_code, 500, path)
+                if res.mimetype == 'text/event-stream':
+                    next(iter(res.response))
+                res.close()
+        return statements
+
+    def explain(self, cursor, statement):
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + statement)
+        plan = cursor.fetchone()[0][0]['Plan']
+        problems = []
+        if plan['Total Cost'] > MAX_COST:
+            problems.append(f'cost {plan["Total Cost"]:.0f} > {MAX_COST:.0f}')
+        for node in plan_nodes(plan):
+            rows = self.table_rows.get(node.get('Relation Name'), 0)
+            if node['Node Type'] == 'Seq Scan' and rows > SEQ_SCAN_ROWS:
+                problems.append(
+                    f'seq scan on {node["Relation Name"]} ({rows:.0f} rows)'
+                )
+        return problems
+
+    def test_every_route_is_checked(self):
+        checked = {
+            main.app.url_map.bind('localhost').match(
+                path.split('?')[0], method=method
+            )[0]
+            for _, method, path, _ in self.routes()
+        }
+        endpoints = {
+            rule.endpoint for rule in main.app.url_map.iter_rules()
+        } - {'static'}
+        self.assertEqual(set(), endpoints - checked)
+
+    def test_statements_stay_within_budget(self):
+        statements = self.capture(self.routes())
+        self.assertTrue(statements)
+        conn = main.connect_db()
+        try:
+            cursor = conn.cursor()
+            seen = set()
+            for endpoint, statement in statements:
+                if statement in seen or \
+                        not statement.lstrip().upper().startswith(EXPLAINABLE):
+                    continue
+                seen.add(statement)
+                with self.subTest(endpoint=endpoint, statement=statement):
+                    self.assertEqual([], self.explain(cursor, statement))
+                conn.rollback()
+        finally:
+            conn.close()
@@ -1,3 +1,12 @@
+import gzip
+import html
+import io
+import os
+import re
+from unittest import mock
+from flask import g
+from PIL import Image
+import main
 from test.app_testcase import AppTestCase
 
 
@@ -82,3 +91,239 @@ class PostTest(AppTestCase):
         res = self.client.get('/posts/search?query=aho')
         self.assertIn(b'expected1', res.data)
         self.assertIn(b'expected2', res.data)
+
+    def test_search_is_ranked_and_cached(self):
+        self.listen_for_notifications()
+        self.register('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'expected2', 'ahoho')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'aho', 'expected1')
+
+        res = self.client.get('/posts/search?query=%20aho')
+        self.assertLess(res.data.index(b'expected1'),
+                        res.data.index(b'expected2'))
+        hits = main.search_cache.hits
+        res = self.client.get('/posts/search?query=aho%20')
+        self.assertEqual(hits + 1, main.search_cache.hits)
+
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'expected3', 'aho')
+        res = self.client.get('/posts/search?query=aho')
+        self.assertIn(b'expected3', res.data)
+
+    def test_post_cards_are_reused(self):
+        self.register('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'hoge', 'fuga')
+
+        self.client.get('/posts')
+        hits = main.post_cards.hits
+        res = self.client.get('/@alice')
+        self.assertEqual(hits + 1, main.post_cards.hits)
+        self.assertIn(b'hoge', res.data)
+
+        self.favorite(1)
+        res = self.client.get('/posts')
+        self.assertEqual(hits + 1, main.post_cards.hits)
+        self.assertIn(b'by 1 users', res.data)
+
+    def test_post_page_reuses_helper_queries(self):
+        self.register('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'hoge', 'fuga')
+
+        with self.client:
+            res = self.client.get('/post/1')
+            self.assertIn(b'Delete this post', res.data)
+            self.assertGreaterEqual(g.queries_avoided, 2)
+
+    def test_post_list_is_paginated(self):
+        page_size = main.app.config['PAGE_SIZE']
+        main.app.config['PAGE_SIZE'] = 2
+        self.addCleanup(main.app.config.__setitem__, 'PAGE_SIZE', page_size)
+
+        self.register('alice', 'alicealice')
+        for i in range(3):
+            with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+                self.upload(f, f'hoge{i}', f'fuga{i}')
+
+        res = self.client.get('/posts')
+        self.assertIn(b'hoge2', res.data)
+        self.assertIn(b'hoge1', res.data)
+        self.assertNotIn(b'hoge0', res.data)
+
+        next_url = re.search(rb'href="([^"]*after=[^"]*)"', res.data).group(1)
+        res = self.client.get(html.unescape(next_url.decode()))
+        self.assertIn(b'hoge0', res.data)
+        self.assertNotIn(b'hoge1', res.data)
+
+        prev_url = re.search(rb'href="([^"]*before=[^"]*)"', res.data).group(1)
+        res = self.client.get(html.unescape(prev_url.decode()))
+        self.assertIn(b'hoge2', res.data)
+        self.assertIn(b'hoge1', res.data)
+        self.assertNotIn(b'before=', res.data)
+
+    def test_invalid_page_cursor_should_be_400(self):
+        res = self.client.get('/posts?after=notanumber')
+        self.assertEqual(400, res.status_code)
+
+    def test_post_list_can_be_streamed(self):
+        page_size = main.app.config['PAGE_SIZE']
+        main.app.config['PAGE_SIZE'] = 2
+        self.addCleanup(main.app.config.__setitem__, 'PAGE_SIZE', page_size)
+        self.addCleanup(main.app.config.__setitem__, 'STREAM_LISTINGS', False)
+
+        self.register('alice', 'alicealice')
+        for i in range(3):
+            with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+                self.upload(f, f'hoge{i}', f'fuga{i}')
+        rendered = self.client.get('/posts').data
+
+        main.app.config['STREAM_LISTINGS'] = True
+        exit_block = main.RequestConnection.__exit__
+        with mock.patch.object(main.RequestConnection, '__exit__',
+                               autospec=True,
+                               side_effect=exit_block) as exited:
+            res = self.client.get('/posts')
+            self.assertTrue(res.is_streamed)
+            self.assertEqual(rendered, res.data)
+        # A full page stops reading early, which is not a failure
+        self.assertTrue(exited.called)
+        self.assertEqual([], [
+            call for call in exited.call_args_list if call[0][1] is not None
+        ])
+
+        res = self.client.get('/posts', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', res.headers['Content-Encoding'])
+        self.assertEqual(rendered, gzip.decompress(res.data))
+
+        next_url = re.search(rb'href="([^"]*after=[^"]*)"', rendered).group(1)
+        res = self.client.get(html.unescape(next_url.decode()))
+        self.assertIn(b'hoge0', res.data)
+        self.assertNotIn(b'hoge1', res.data)
+        self.assertNotIn(b'after=', res.data)
+        self.assertIn(b'before=', res.data)
+
+    def test_streamed_user_page_without_posts(self):
+        self.addCleanup(main.app.config.__setitem__, 'STREAM_LISTINGS', False)
+        main.app.config['STREAM_LISTINGS'] = True
+        self.register('alice', 'alicealice')
+        res = self.client.get('/@alice')
+        self.assertTrue(res.is_streamed)
+        self.assertNotIn(b"@alice's post", res.data)
+
+    def test_rows_are_indexed_by_name(self):
+        row = main.row_class(('id', 'title'))((1, 'hoge'))
+        self.assertEqual((1, 'hoge'), row)
+        self.assertEqual('hoge', row['title'])
+        self.assertEqual(1, row[0])
+        self.assertIn('title', row)
+        self.assertNotIn('username', row)
+        self.assertIsNone(row.get('username'))
+        self.assertIs(type(row), main.row_class(('id', 'title')))
+
+    def test_upload_generates_derivatives(self):
+        self.register('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'hoge', 'fuga')
+
+        res = self.client.get('/posts')
+        thumb = re.search(rb"url\('(/uploads/[^']*\.thumb\.png)'\)",
+                          res.data).group(1).decode()
+        res = self.client.get(thumb)
+        self.assertEqual(200, res.status_code)
+        with Image.open(io.BytesIO(res.data)) as image:
+            self.assertLessEqual(max(image.size), 256)
+
+    def test_missing_derivative_falls_back_to_original(self):
+        self.register('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'hoge', 'fuga')
+        res = self.client.get('/post/1')
+        original = re.search(rb'<a href="(/uploads/[^"]*)"',
+                             res.data).group(1).decode()
+        os.remove(os.path.join(main.app.config['UPLOAD_FOLDER'],
+                               main.derivative_name(original[9:], 'medium')))
+
+        res = self.client.get(main.derivative_name(original, 'medium'))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(self.client.get(original).data, res.data)
+
+    def test_uploads_are_immutable(self):
+        self.register('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, 'hoge', 'fuga')
+        res = self.client.get('/post/1')
+        url = re.search(rb'<a href="(/uploads/[^"]*)"', res.data).group(1)
+
+        res = self.client.get(url.decode(),
+                              headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(200, res.status_code)
+        self.assertIn('immutable', res.headers['Cache-Control'])
+        self.assertNotIn('Content-Encoding', res.headers)
+        etag, weak = res.get_etag()
+        self.assertFalse(weak)
+        self.assertIn(etag.encode(), url)
+
+        res = self.client.get(url.decode(),
+                              headers={'If-None-Match': f'"{etag}"'})
+        self.assertEqual(304, res.status_code)
+
+        res = self.client.get(url.decode(), headers={'Range': 'bytes=0-9'})
+        self.assertEqual(206, res.status_code)
+        self.assertEqual(10, len(res.data))
+
+    def test_same_content_is_stored_once(self):
+        self.register('alice', 'alicealice')
+        for i in range(2):
+            with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+                self.upload(f, f'hoge{i}', f'fuga{i}')
+
+        folder = main.app.config['UPLOAD_FOLDER']
+        originals = [filename for filename in os.listdir(folder)
+                     if main.original_name(filename) is None]
+        self.assertEqual(1, len(originals))
+
+    def test_cannot_upload_too_large_file(self):
+        max_upload_size = main.app.config['MAX_UPLOAD_SIZE']
+        main.app.config['MAX_UPLOAD_SIZE'] = 1024
+        self.addCleanup(main.app.config.__setitem__, 'MAX_UPLOAD_SIZE',
+                        max_upload_size)
+
+        self.register('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            res = self.upload(f, 'hoge', 'fuga')
+        self.assertIn(b'smaller than 1 KiB', res.data)
+        self.assertEqual([], os.listdir(main.app.config['UPLOAD_FOLDER']))
+
+    def test_file_over_upload_size_is_not_kept(self):
+        path = './test/data/kids_chuunibyou_girl.png'
+        max_upload_size = main.app.config['MAX_UPLOAD_SIZE']
+        # Within the request limit, so it is only caught while spooled
+        main.app.config['MAX_UPLOAD_SIZE'] = os.path.getsize(path) - 1
+        self.addCleanup(main.app.config.__setitem__, 'MAX_UPLOAD_SIZE',
+                        max_upload_size)
+
+        self.register('alice', 'alicealice')
+        with open(path, 'rb') as f:
+            res = self.upload(f, 'hoge', 'fuga')
+        self.assertIn(b'You cannot upload the file', res.data)
+        self.assertEqual([], os.listdir(main.app.config['UPLOAD_FOLDER']))
+
+    def test_upload_is_spooled_once(self):
+        path = './test/data/kids_chuunibyou_girl.png'
+        self.register('alice', 'alicealice')
+        write = main.UploadSpool.write
+        with mock.patch.object(main.UploadSpool, 'write', autospec=True,
+                               side_effect=write) as spooled:
+            with open(path, 'rb') as f:
+                res = self.upload(f, 'hoge', 'fuga')
+        self.assertIn(b'hoge', res.data)
+        self.assertEqual(os.path.getsize(path), sum(
+            len(call[0][1]) for call in spooled.call_args_list
+        ))
+        self.assertFalse(any(
+            name.endswith('.tmp')
+            for name in os.listdir(main.app.config['UPLOAD_FOLDER'])
+        ))
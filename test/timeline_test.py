@@ -0,0 +1,96 @@
+import main
+from test.app_testcase import AppTestCase
+
+
+class TimelineTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fanout_limit = main.app.config['TIMELINE_FANOUT_LIMIT']
+        self.timeline_size = main.app.config['TIMELINE_SIZE']
+        self.register('alice', 'alicealice')
+        self.logout()
+        self.register('bobby', 'bobbobbob')
+        self.follow('alice')
+        self.logout()
+
+    def tearDown(self):
+        main.app.config['TIMELINE_FANOUT_LIMIT'] = self.fanout_limit
+        main.app.config['TIMELINE_SIZE'] = self.timeline_size
+
+    def following_feed(self):
+        res = self.client.get('/')
+        return res.data.split(b'Posts by following user')[1]
+
+    def count_timeline_entries(self):
+        conn = main.connect_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) FROM timelines')
+            return cursor.fetchone()[0]
+        finally:
+            conn.close()
+
+    def upload_as_alice(self, title):
+        self.login('alice', 'alicealice')
+        with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+            self.upload(f, title, 'fuga')
+        self.logout()
+
+    def test_post_is_pushed_to_followers(self):
+        self.upload_as_alice('hoge')
+        self.login('bobby', 'bobbobbob')
+        # Not delivered yet, so it is pulled at read time
+        self.assertIn(b'hoge', self.following_feed())
+
+        self.drain_outbox()
+        self.assertEqual(1, self.count_timeline_entries())
+        self.assertIn(b'hoge', self.following_feed())
+
+    def test_post_of_popular_author_is_pulled(self):
+        main.app.config['TIMELINE_FANOUT_LIMIT'] = 0
+        self.upload_as_alice('hoge')
+        self.drain_outbox()
+        self.assertEqual(0, self.count_timeline_entries())
+
+        self.login('bobby', 'bobbobbob')
+        self.assertIn(b'hoge', self.following_feed())
+
+    def test_unfollow_removes_entries(self):
+        self.upload_as_alice('hoge')
+        self.drain_outbox()
+
+        self.login('bobby', 'bobbobbob')
+        self.unfollow('alice')
+        self.assertEqual(0, self.count_timeline_entries())
+        self.assertNotIn(b'hoge', self.following_feed())
+
+        self.follow('alice')
+        self.assertEqual(1, self.count_timeline_entries())
+        self.assertIn(b'hoge', self.following_feed())
+
+    def test_follow_keeps_timeline_size(self):
+        main.app.config['TIMELINE_SIZE'] = 2
+        self.upload_as_alice('hoge')
+        self.upload_as_alice('fuga')
+        self.register('carol', 'carolcarol')
+        for title in ('piyo', 'moge'):
+            with open('./test/data/kids_chuunibyou_girl.png', 'rb') as f:
+                self.upload(f, title, 'fuga')
+        self.logout()
+        self.drain_outbox()
+        self.assertEqual(2, self.count_timeline_entries())
+
+        self.login('bobby', 'bobbobbob')
+        self.follow('carol')
+        self.assertEqual(2, self.count_timeline_entries())
+        feed = self.following_feed()
+        self.assertIn(b'piyo', feed)
+        self.assertIn(b'moge', feed)
+
+    def test_deleted_post_is_removed(self):
+        self.upload_as_alice('hoge')
+        self.drain_outbox()
+
+        self.login('alice', 'alicealice')
+        self.delete_post(1)
+        self.assertEqual(0, self.count_timeline_entries())
@@ -1,3 +1,5 @@
+import time
+import main
 from test.app_testcase import AppTestCase
 
 
@@ -139,3 +141,35 @@ class UserTest(AppTestCase):
 
         res = self.client.get('/@bobby/follower', follow_redirects=True)
         self.assertIn(b'alice', res.data)
+
+    def test_profile_is_cached_across_requests(self):
+        self.listen_for_notifications()
+        self.register('alice', 'alicealice')
+        self.client.get('/mypage', follow_redirects=True)
+        hits = main.user_cache.hits
+        res = self.client.get('/mypage', follow_redirects=True)
+        self.assertIn(b'@alice', res.data)
+        self.assertLess(hits, main.user_cache.hits)
+
+    def test_profile_change_by_another_process_is_seen(self):
+        self.listen_for_notifications()
+        self.register('alice', 'alicealice')
+        self.client.get('/setting')
+
+        with main.connect_db() as conn:
+            conn.cursor().execute('''
+            UPDATE users SET description = 'changed elsewhere'
+            WHERE username = 'alice'
+            ''')
+        deadline = time.monotonic() + 5
+        while b'changed elsewhere' not in self.client.get('/setting').data:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+    def test_unknown_username_is_not_cached_after_registration(self):
+        res = self.client.get('/@alice')
+        self.assertEqual(404, res.status_code)
+        self.register('alice', 'alicealice')
+        self.logout()
+        res = self.client.get('/@alice')
+        self.assertEqual(200, res.status_code)